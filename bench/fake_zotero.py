@@ -0,0 +1,372 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+''' Local stand-in for the parts of the Zotero web API that zot-sync uses.
+
+    Serves synthetic libraries over HTTP so syncs can be measured without
+    api.zotero.org. Start it from Python with FakeZotero().start(), or run
+    this file and point zot-sync at it with ZOTERO_API_URL.
+    A websocket request to any path gets a minimal stand-in of the streaming
+    API (stream.zotero.org): FakeZotero.notify() sends topicUpdated events.
+    Attachment files are redirected to /files/<md5>, which honours ranges.
+'''
+
+import base64, hashlib, http.server, json, random, string, struct, threading, urllib.parse
+
+ITEM_FIELDS = {
+    'book': ['title', 'publisher', 'place', 'date', 'ISBN', 'numPages', 'url', 'accessDate', 'abstractNote'],
+    'journalArticle': ['title', 'publicationTitle', 'volume', 'issue', 'pages', 'date', 'DOI', 'ISSN', 'url', 'abstractNote'],
+    'bookSection': ['title', 'bookTitle', 'publisher', 'place', 'date', 'pages', 'ISBN', 'abstractNote'],
+    'report': ['title', 'institution', 'reportNumber', 'date', 'url', 'abstractNote'],
+    'attachment': ['title', 'accessDate', 'url'],
+}
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+BASE_FIELDS = { 'bookTitle': 'publicationTitle', 'institution': 'publisher', 'reportNumber': 'number' }
+
+def _schema() :
+    item_types = []
+    for item_type,fields in ITEM_FIELDS.items() :
+        item_types.append({ 'itemType': item_type, 'fields': [
+            dict({ 'field': f }, **({ 'baseField': BASE_FIELDS[f] } if f in BASE_FIELDS else {})) for f in fields ] })
+    item_types.append({ 'itemType': 'note', 'fields': [] })
+    return { 'version': 1, 'itemTypes': item_types }
+
+def _file(key) :
+    ''' Content of an attachment file, one of 100 so that libraries share files.
+    '''
+    n = int(hashlib.md5(key.encode('ascii')).hexdigest(), 16) % 100
+    return (b'%%PDF-1.4 synthetic file %i\n' % n) * (1000 + 100 * n)
+
+def _key(rng) :
+    return ''.join(rng.choice(string.ascii_uppercase + string.digits) for i in range(8))
+
+class FakeLibrary(object):
+    ''' A synthetic library with a version counter, like a Zotero library.
+    '''
+    def __init__(self, library_type, library_id, items = 1000, mix = None, children = 0.3, collections = 20, seed = 0):
+        self.library_type = library_type
+        self.library_id = library_id
+        self.name = 'Synthetic %s %i' % (library_type, library_id)
+        self.rng = random.Random(seed)
+        self.mix = mix or { 'journalArticle': 5, 'book': 2, 'bookSection': 2, 'report': 1 }
+        self.version = 0
+        self.items = {}
+        self.deleted = {}   # key: version of deletion
+        self.collections = {}
+        self.tags = {}      # tag: version
+        self.fulltext = {}  # attachment key: full-text response with its version
+        self.files = {}     # md5: content of the attachment files
+        for i in range(collections) :
+            self.version += 1
+            key = _key(self.rng)
+            self.collections[key] = { 'key': key, 'version': self.version,
+                'data': { 'key': key, 'version': self.version, 'name': 'Collection %i' % i, 'parentCollection': False, 'relations': {} },
+                'meta': { 'numCollections': 0, 'numItems': 0 } }
+        self.version += 1
+        top_level = int(items * (1 - children))
+        for i in range(top_level) :
+            self._write(self._new_item())
+        parents = list(self.items)
+        for i in range(items - top_level) :
+            self._write(self._new_item(self.rng.choice(parents)))
+
+    def _new_item(self, parent = None) :
+        key = _key(self.rng)
+        if parent :
+            item_type = self.rng.choice(['note', 'attachment'])
+        else :
+            item_type = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        data = { 'key': key, 'itemType': item_type, 'tags': [], 'relations': {},
+                 'dateAdded': '2020-01-01T00:00:00Z' }
+        if item_type == 'note' :
+            data['note'] = '<p>%s</p>' % ' '.join(_key(self.rng) for i in range(20))
+        else :
+            for field in ITEM_FIELDS[item_type] :
+                data[field] = '' if field == 'accessDate' else ' '.join(_key(self.rng) for i in range(3))
+        if item_type == 'attachment' :
+            content = _file(key)
+            md5 = hashlib.md5(content).hexdigest()
+            self.files[md5] = content
+            data.update(linkMode='imported_file', contentType='application/pdf', charset='',
+                        filename='%s.pdf' % key, md5=md5, mtime=1577836800000)
+        if parent :
+            data['parentItem'] = parent
+        else :
+            data['creators'] = [ { 'creatorType': 'author', 'firstName': _key(self.rng), 'lastName': _key(self.rng) } ]
+            data['collections'] = self.rng.sample(list(self.collections), min(2, len(self.collections)))
+        data['tags'] = [ { 'tag': 'tag%i' % self.rng.randrange(50) } ]
+        return data
+
+    def _write(self, data) :
+        data['version'] = self.version
+        data['dateModified'] = '2021-01-01T00:00:00Z'
+        self.items[data['key']] = data
+        for tag in data['tags'] :
+            self.tags[tag['tag']] = self.version
+        if data['itemType'] == 'attachment' and data['key'] not in self.fulltext :
+            content = ' '.join(_key(self.rng) for i in range(200))
+            self.fulltext[data['key']] = { 'version': self.version,
+                'content': content, 'indexedPages': 1, 'totalPages': 1 }
+
+    def churn(self, changes = 0.01, deletions = 0.002, inserts = 0.005) :
+        """ Advance the library by one version with a share of modified, deleted and new items.
+        """
+        self.version += 1
+        keys = list(self.items)
+        for key in self.rng.sample(keys, int(len(keys) * changes)) :
+            self.items[key]['title' if 'title' in self.items[key] else 'note'] = 'changed %s' % _key(self.rng)
+            self._write(self.items[key])
+        for key in self.rng.sample(keys, int(len(keys) * deletions)) :
+            if key in self.items :
+                del self.items[key]
+                self.deleted[key] = self.version
+                self.fulltext.pop(key, None)
+                for child in [ k for k,i in self.items.items() if i.get('parentItem') == key ] :
+                    del self.items[child]
+                    self.deleted[child] = self.version
+                    self.fulltext.pop(child, None)
+        for i in range(int(len(keys) * inserts)) :
+            self._write(self._new_item())
+
+    def api_item(self, data) :
+        meta = {}
+        if data['itemType'] not in ('note', 'attachment') :
+            meta['numChildren'] = 0
+        return { 'key': data['key'], 'version': data['version'],
+                 'library': { 'type': self.library_type, 'id': self.library_id, 'name': self.name },
+                 'data': data, 'meta': meta }
+
+class FakeZotero(object):
+    ''' HTTP server for any number of FakeLibrary objects.
+        Counts requests so a benchmark can report them.
+    '''
+    def __init__(self, libraries = (), user_id = 1, api_key = 'fakekey'):
+        self.libraries = { (l.library_type, l.library_id): l for l in libraries }
+        self.user_id = user_id
+        self.api_key = api_key
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.streams = []
+        self.interrupt = None   # end file responses after this many bytes, to exercise resuming
+        self.throttle = 0       # answer this many of the next API requests with 429
+        self.retry_after = '1'  # Retry-After of those, seconds or an HTTP date
+        self.backoff = None     # Backoff header sent with every API response
+
+    @property
+    def url(self) :
+        return 'http://127.0.0.1:%i' % self.server.server_port
+
+    @property
+    def stream_url(self) :
+        return 'ws://127.0.0.1:%i' % self.server.server_port
+
+    def notify(self, library) :
+        """ Send a topicUpdated event for a library to all subscribed stream connections.
+        """
+        topic = '/%ss/%i' % (library.library_type, library.library_id)
+        with self.lock :
+            streams = list(self.streams)
+        for stream in streams :
+            if stream.topics is None or topic in stream.topics :
+                stream.send_event({ 'event': 'topicUpdated', 'topic': topic, 'version': library.version })
+
+    def start(self, port = 0) :
+        fake = self
+        class Handler(_Handler) :
+            zotero = fake
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) :
+        self.server.shutdown()
+        self.server.server_close()
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    zotero = None
+
+    def log_message(self, *args) :
+        pass
+
+    def _send(self, status, body = None, headers = {}) :
+        payload = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+        self.send_response(status)
+        if self.zotero.backoff is not None :
+            self.send_header('Backoff', str(self.zotero.backoff))
+        for name,value in headers.items() :
+            self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_file(self, content) :
+        start = 0
+        status = 200
+        headers = {}
+        if self.headers.get('Range', '').startswith('bytes=') :
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            if start >= len(content) :
+                return self._send(416, None, { 'Content-Range': 'bytes */%i' % len(content) })
+            status = 206
+            headers['Content-Range'] = 'bytes %i-%i/%i' % (start, len(content) - 1, len(content))
+        self.send_response(status)
+        for name,value in headers.items() :
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        if self.zotero.interrupt is not None :
+            self.wfile.write(content[start:start+self.zotero.interrupt])
+            self.close_connection = True
+        else :
+            self.wfile.write(content[start:])
+
+    def _read_frame(self) :
+        head = self.rfile.read(2)
+        if len(head) < 2 :
+            return (8, b'')
+        length = head[1] & 0x7f
+        if length == 126 :
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127 :
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if head[1] & 0x80 else b'\0\0\0\0'
+        payload = bytes(b ^ mask[i % 4] for i,b in enumerate(self.rfile.read(length)))
+        return (head[0] & 0x0f, payload)
+
+    def _write_frame(self, opcode, payload) :
+        length = len(payload)
+        if length < 126 :
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536 :
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else :
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.stream_lock :
+            self.wfile.write(header + payload)
+
+    def send_event(self, event) :
+        try :
+            self._write_frame(1, json.dumps(event).encode('utf-8'))
+        except OSError :
+            pass
+
+    def _stream(self) :
+        accept = base64.b64encode(hashlib.sha1((self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode('ascii')).digest())
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode('ascii'))
+        self.end_headers()
+        self.stream_lock = threading.Lock()
+        self.topics = None
+        self.send_event({ 'event': 'connected', 'retry': 1000 })
+        with self.zotero.lock :
+            self.zotero.streams.append(self)
+        try :
+            while True :
+                opcode, payload = self._read_frame()
+                if opcode == 8 :
+                    break
+                elif opcode == 9 :
+                    self._write_frame(10, payload)
+                elif opcode == 1 :
+                    message = json.loads(payload.decode('utf-8'))
+                    if message.get('action') == 'createSubscriptions' :
+                        topics = [ t for s in message['subscriptions'] for t in s.get('topics', []) ]
+                        # A key without topics subscribes to all of its libraries
+                        self.topics = set(topics) if topics else None
+                        self.send_event({ 'event': 'subscriptionsCreated',
+                            'subscriptions': message['subscriptions'], 'errors': [] })
+        finally :
+            with self.zotero.lock :
+                self.zotero.streams.remove(self)
+            self.close_connection = True
+
+    def do_GET(self) :
+        if self.headers.get('Upgrade', '').lower() == 'websocket' :
+            return self._stream()
+        with self.zotero.lock :
+            self.zotero.requests += 1
+            throttled = self.zotero.throttle > 0
+            if throttled :
+                self.zotero.throttle -= 1
+        if throttled :
+            return self._send(429, b'Too many requests', { 'Retry-After': self.zotero.retry_after })
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        if parts == ['schema'] :
+            return self._send(200, _schema(), { 'ETag': '"fake-schema-1"', 'Last-Modified': 'Thu, 01 Jan 2020 00:00:00 GMT' })
+        if parts[0] == 'files' :
+            for library in self.zotero.libraries.values() :
+                if parts[1] in library.files :
+                    return self._send_file(library.files[parts[1]])
+            return self._send(404, b'Not found')
+        if parts[0] == 'keys' :
+            return self._send(200, { 'key': parts[1], 'userID': self.zotero.user_id, 'username': 'fake',
+                'access': { 'user': { 'library': True }, 'groups': { 'all': { 'library': True } } } })
+        if parts[0] == 'users' and parts[2:] == ['groups'] :
+            groups = [ { 'id': l.library_id, 'version': l.version, 'data': { 'id': l.library_id, 'name': l.name } }
+                for (t,i),l in sorted(self.zotero.libraries.items()) if t == 'group' ]
+            return self._send(200, groups, { 'Total-Results': len(groups) })
+        library = self.zotero.libraries.get((parts[0][:-1], int(parts[1])))
+        if library is None :
+            return self._send(404, b'Not found')
+        since = int(params.get('since', 0))
+        headers = { 'Last-Modified-Version': library.version }
+        if int(self.headers.get('If-Modified-Since-Version', -1)) >= library.version :
+            return self._send(304, None, headers)
+        resource = parts[2:]
+        if resource in (['items'], ['items', 'top']) :
+            items = [ i for i in library.items.values() if i['version'] > since ]
+            if resource == ['items', 'top'] :
+                items = [ i for i in items if 'parentItem' not in i ]
+            if 'itemKey' in params :
+                keys = params['itemKey'].split(',')
+                items = [ library.items[k] for k in keys if k in library.items ]
+            items.sort(key=lambda i : (i['dateModified'], i['key']))
+            headers['Total-Results'] = len(items)
+            start = int(params.get('start', 0))
+            if params.get('format') in ('versions', 'keys') and 'limit' in params :
+                items = items[start:start+int(params['limit'])]
+            if params.get('format') == 'versions' :
+                return self._send(200, { i['key']: i['version'] for i in items }, headers)
+            if params.get('format') == 'keys' :
+                return self._send(200, '\n'.join(i['key'] for i in items).encode('utf-8'), headers)
+            limit = int(params.get('limit', 25))
+            return self._send(200, [ library.api_item(i) for i in items[start:start+limit] ], headers)
+        if resource == ['fulltext'] :
+            return self._send(200, { k: f['version'] for k,f in library.fulltext.items() if f['version'] > since }, headers)
+        if len(resource) == 3 and resource[0] == 'items' and resource[2] == 'fulltext' :
+            if resource[1] not in library.fulltext :
+                return self._send(404, b'Not found', headers)
+            content = dict(library.fulltext[resource[1]])
+            del content['version']
+            return self._send(200, content, headers)
+        if len(resource) == 3 and resource[0] == 'items' and resource[2] == 'file' :
+            item = library.items.get(resource[1])
+            if item is None or not item.get('md5') :
+                return self._send(404, b'Not found', headers)
+            return self._send(302, None, dict(headers, Location='%s/files/%s' % (self.zotero.url, item['md5'])))
+        if resource == ['deleted'] :
+            return self._send(200, { 'items': [ k for k,v in library.deleted.items() if v > since ],
+                'collections': [], 'searches': [], 'tags': [], 'settings': [] }, headers)
+        if resource == ['collections'] :
+            return self._send(200, [ c for c in library.collections.values() if c['version'] > since ], headers)
+        if resource == ['searches'] :
+            return self._send(200, [], headers)
+        if resource == ['tags'] :
+            return self._send(200, [ { 'tag': t, 'meta': { 'type': 0 } } for t,v in library.tags.items() if v > since ], headers)
+        return self._send(404, b'Not found')
+
+if __name__ == '__main__' :
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve synthetic Zotero libraries.')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=1)
+    args = parser.parse_args()
+    fake = FakeZotero([ FakeLibrary('group', i+1, args.items, seed=i) for i in range(args.groups) ]).start(args.port)
+    print('Serving %i synthetic group libraries at %s, streaming API at %s' % (args.groups, fake.url, fake.stream_url))
+    threading.Event().wait()
@@ -3,7 +3,7 @@ import setuptools
 required = [
     'Click',
     'SQLAlchemy',
-    'pyzotero',
+    'requests',
 ]
 
 # Please choose what works for you,
@@ -15,6 +15,12 @@ psycopg2 = {
     'alternative': ['psycopg2-binary']
 }
 
+# zot-sync watch --stream follows the Zotero streaming API over a websocket,
+# example: pip install zot-sync[recommended,stream]
+optional = {
+    'stream': ['websocket-client'],
+}
+
 setuptools.setup(
     name='zot-sync',
     version='0.3.2',
@@ -25,7 +31,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     include_package_data=True,
     install_requires= required,
-    extras_require= psycopg2,
+    extras_require= dict(psycopg2, **optional),
     entry_points={
         'console_scripts': [
             'zot-sync=zot_sync.cli:run',
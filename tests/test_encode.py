@@ -0,0 +1,103 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+''' Tests of the wide and compact row encoders in zot_sync.encode with a small item schema.
+    They need no database: python -m pytest tests
+'''
+
+import json, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zot_sync import encode, schema
+
+# In the shape schema.from_zotero returns: item types with their fields, and the type of every base column
+SCHEMA = {
+    'itemTypes': [
+        { 'itemType': 'book', 'fields': [ { 'field': 'title' }, { 'field': 'publisher' }, { 'field': 'accessDate' } ] },
+        { 'itemType': 'bookSection', 'fields': [ { 'field': 'title' }, { 'field': 'bookTitle', 'baseField': 'publicationTitle' } ] },
+        { 'itemType': 'note', 'fields': [ { 'field': 'note', 'baseField': 'title' }, { 'field': 'customJSON' } ] },
+        { 'itemType': 'attachment', 'fields': [ { 'field': 'title' }, { 'field': 'accessDate' } ] },
+    ],
+    'fields': { 'accessDate': 'timestamp', 'customJSON': 'jsonb', 'publicationTitle': 'varchar(65535)',
+                'publisher': 'varchar(65535)', 'title': 'varchar(65535)' },
+}
+
+def _item(**data) :
+    meta = data.pop('meta', {})
+    data.setdefault('version', 1)
+    return { 'key': data['key'], 'version': data['version'], 'data': data, 'meta': meta }
+
+def _row(item, layout = 'wide') :
+    columns, values = encode.Encoders(SCHEMA, layout).encode(item)
+    assert len(columns) == len(values)
+    return dict(zip(columns, values))
+
+def test_wide_row_carries_every_field_of_its_type() :
+    row = _row(_item(key='AAAAAAAA', itemType='book', title='A book', publisher='',
+        tags=[ { 'tag': 'x' } ], collections=[], meta={ 'numChildren': 2, 'creatorSummary': 'Doe' }))
+    assert row['key'] == 'AAAAAAAA' and row['itemType'] == 'book' and row['title'] == 'A book'
+    # Empty and missing fields are NULL, so a row always overwrites the previous state
+    assert row['publisher'] is None and row['accessDate'] is None and row['collections'] is None
+    assert row['deleted'] is False
+    assert json.loads(row['tags']) == [ { 'tag': 'x' } ]
+    assert row['numChildren'] == 2 and row['creatorSummary'] == 'Doe'
+    assert 'publicationTitle' not in row and 'md5' not in row
+
+def test_wide_row_stores_fields_in_their_base_column() :
+    row = _row(_item(key='AAAAAAAA', itemType='bookSection', title='A chapter', bookTitle='A book', deleted=1))
+    assert row['publicationTitle'] == 'A book'
+    assert 'bookTitle' not in row
+    assert row['deleted'] is True
+
+def test_wide_row_of_child_items() :
+    note = _row(_item(key='BBBBBBBB', itemType='note', parentItem='AAAAAAAA', note='<p>{"a": 1}</p>'))
+    assert note['title'] == '<p>{"a": 1}</p>' and note['parentItem'] == 'AAAAAAAA'
+    assert json.loads(note['customJSON']) == { 'a': 1 }
+    attachment = _row(_item(key='CCCCCCCC', itemType='attachment', parentItem='AAAAAAAA',
+        linkMode='imported_file', md5='0' * 32, mtime=1577836800000, filename='a.pdf'))
+    assert attachment['md5'] == '0' * 32 and attachment['mtime'] == 1577836800000 and attachment['filename'] == 'a.pdf'
+
+def test_annotation_fields_have_columns() :
+    # The schema declares no fields for annotations, they have columns of their own
+    item = _item(key='DDDDDDDD', itemType='annotation', parentItem='CCCCCCCC', annotationType='highlight',
+        annotationText='quoted', annotationComment='', annotationColor='#ffd400', annotationPageLabel='12',
+        annotationSortIndex='00011|001234|00056', annotationPosition='{"pageIndex": 11}')
+    row = _row(item)
+    assert row['parentItem'] == 'CCCCCCCC' and row['annotationType'] == 'highlight'
+    assert row['annotationText'] == 'quoted' and row['annotationComment'] is None
+    assert row['annotationPosition'] == '{"pageIndex": 11}' and row['annotationSortIndex'] == '00011|001234|00056'
+    assert json.loads(_row(item, 'compact')['data'])['annotationColor'] == '#ffd400'
+
+def test_invalid_json_in_note_is_no_error() :
+    assert _row(_item(key='BBBBBBBB', itemType='note', note='{not json}'))['customJSON'] is None
+
+def test_unknown_item_type_gets_the_common_columns() :
+    row = _row(_item(key='AAAAAAAA', itemType='dataset', title='Data'))
+    assert row['itemType'] == 'dataset'
+    assert 'title' not in row
+
+def test_null_fields_are_accepted() :
+    row = _row(_item(key='AAAAAAAA', itemType='book', title=None, creators=None, parentItem=None))
+    assert row['title'] is None and row['creators'] is None
+
+def test_compact_row_keeps_hot_columns_typed() :
+    row = _row(_item(key='AAAAAAAA', itemType='bookSection', title='A chapter', bookTitle='A book',
+        dateAdded='', tags=[ { 'tag': 'x' } ], meta={ 'numChildren': 0 }), 'compact')
+    assert sorted(row) == sorted(schema.COMPACT_COLUMNS + ('data', 'meta'))
+    assert row['title'] == 'A chapter' and row['dateAdded'] is None and row['deleted'] is False
+    data = json.loads(row['data'])
+    assert data == { 'bookTitle': 'A book', 'tags': [ { 'tag': 'x' } ] }
+    assert json.loads(row['meta']) == { 'numChildren': 0 }
+
+def test_compact_row_of_a_note() :
+    row = _row(_item(key='BBBBBBBB', itemType='note', parentItem='AAAAAAAA', note='<p>{"a": 1}</p>'), 'compact')
+    # The note is the title of a note item and not repeated in "data"
+    assert row['title'] == '<p>{"a": 1}</p>' and row['parentItem'] == 'AAAAAAAA'
+    assert json.loads(row['data']) == {}
+    assert json.loads(row['meta']) == { 'customJSON': { 'a': 1 } }
+
+def test_encoders_are_cached_per_schema_and_layout() :
+    wide = encode.for_schema(SCHEMA)
+    compact = encode.for_schema(SCHEMA, 'compact')
+    assert wide is not compact
+    assert encode.for_schema(SCHEMA) is wide and encode.for_schema(SCHEMA, 'compact') is compact
+    assert encode.for_schema(dict(SCHEMA)) is not wide
@@ -0,0 +1,146 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+''' Smoke tests of the API client, file downloads and the stream listener
+    against the local stand-in of the Zotero API in bench/fake_zotero.py.
+    They need no database: python -m pytest tests
+'''
+
+import email.utils, hashlib, os, sys, threading, time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+from zot_sync import api, files, metrics, watch
+from fake_zotero import FakeLibrary, FakeZotero
+
+GROUP_ID = 1
+
+@pytest.fixture
+def fake() :
+    library = FakeLibrary('group', GROUP_ID, 200)
+    zotero = FakeZotero([library]).start()
+    base_url = api.base_url
+    api.configure(rate=1000, url=zotero.url)
+    yield zotero
+    zotero.stop()
+    api.base_url = base_url
+    api.scheduler.paused_until = 0
+
+def _library(fake) :
+    return fake.libraries[('group', GROUP_ID)]
+
+def _largest_attachment(fake) :
+    library = _library(fake)
+    return max((i for i in library.items.values() if i.get('md5')), key=lambda i : len(library.files[i['md5']]))
+
+def test_unchanged_library_answers_304(fake) :
+    library = _library(fake)
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    assert z.items(limit=10)
+    version = library.version
+    assert z.items(modified_since=version) is None
+    assert z.request.status_code == 304
+    library.churn()
+    assert z.items(modified_since=version)
+    assert int(z.request.headers['Last-Modified-Version']) == library.version
+
+def test_retry_after_seconds(fake) :
+    fake.throttle = 2
+    fake.retry_after = '1'
+    stats = metrics.Stats('zot_g_%i' % GROUP_ID)
+    z = api.Library(GROUP_ID, 'group', fake.api_key, stats)
+    start = time.monotonic()
+    assert z.items(limit=1)
+    assert time.monotonic() - start >= 1.9
+    assert stats.snapshot()['retries'] == 2
+
+def test_retry_after_http_date(fake) :
+    fake.throttle = 1
+    fake.retry_after = email.utils.formatdate(time.time() + 2, usegmt=True)
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    start = time.monotonic()
+    assert z.items(limit=1)
+    assert time.monotonic() - start >= 0.9
+
+def test_too_many_retries(fake) :
+    fake.throttle = api.MAX_RETRIES + 1
+    fake.retry_after = '0'
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    with pytest.raises(api.ZoteroError) as e :
+        z.items(limit=1)
+    assert e.value.response.status_code == 429
+
+def test_backoff_pauses_later_requests(fake) :
+    fake.backoff = 1
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    z.items(limit=1)
+    fake.backoff = None
+    start = time.monotonic()
+    z.items(limit=1)
+    assert time.monotonic() - start >= 0.9
+
+def test_seconds() :
+    assert api._seconds('5', 1) == 5
+    assert api._seconds(None, 1) == 1
+    assert api._seconds('soon', 1) == 1
+    assert api._seconds(email.utils.formatdate(time.time() - 60, usegmt=True), 1) == 0
+    assert 50 < api._seconds(email.utils.formatdate(time.time() + 60, usegmt=True), 1) <= 60
+
+def test_download_resumes_partial_file(fake, tmp_path) :
+    item = _largest_attachment(fake)
+    content = _library(fake).files[item['md5']]
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    partial = files.path(str(tmp_path), item['md5']) + '.part'
+    fake.interrupt = 100000
+    with pytest.raises((files.DownloadError, requests.RequestException)) :
+        files.download(z, str(tmp_path), item['key'], item['md5'])
+    assert 0 < os.path.getsize(partial) < len(content)
+    fake.interrupt = None
+    assert files.download(z, str(tmp_path), item['key'], item['md5']) == len(content)
+    assert not os.path.exists(partial)
+    with open(files.path(str(tmp_path), item['md5']), 'rb') as f :
+        assert hashlib.md5(f.read()).hexdigest() == item['md5']
+
+@pytest.mark.parametrize('extra', [-1000, 10])
+def test_download_restarts_unresumable_part(fake, tmp_path, extra) :
+    # A part with other content fails the md5 check, one beyond the end of the file gets 416
+    item = _largest_attachment(fake)
+    content = _library(fake).files[item['md5']]
+    target = files.path(str(tmp_path), item['md5'])
+    os.makedirs(os.path.dirname(target))
+    with open(target + '.part', 'wb') as f :
+        f.write(b'x' * (len(content) + extra))
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    assert files.download(z, str(tmp_path), item['key'], item['md5']) == len(content)
+    assert not os.path.exists(target + '.part')
+
+def test_download_without_file(fake, tmp_path) :
+    item = next(i for i in _library(fake).items.values() if not i.get('md5'))
+    z = api.Library(GROUP_ID, 'group', fake.api_key)
+    assert files.download(z, str(tmp_path), item['key'], '0' * 32) is None
+
+@pytest.mark.skipif(watch.websocket is None, reason='needs websocket-client')
+def test_stream_wakes_library(fake) :
+    library = _library(fake)
+    watched = (GROUP_ID, 'group')
+    schedule = watch.Schedule([watched], 60, 3600)
+    assert schedule.next(timeout=0) == watched
+    schedule.done(watched, { 'version': library.version })
+    stop = threading.Event()
+    listener = threading.Thread(target=watch._listen, args=(fake.stream_url, schedule, [watched], fake.api_key, stop), daemon=True)
+    listener.start()
+    try :
+        deadline = time.monotonic() + 5
+        while not any(s.topics for s in fake.streams) :
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        # A notification of the version already synced does not wake it
+        fake.notify(library)
+        assert schedule.next(timeout=0.5) is None
+        library.churn()
+        fake.notify(library)
+        assert schedule.next(timeout=5) == watched
+    finally :
+        stop.set()
@@ -0,0 +1,150 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+''' Tests of reading items for zot-sync import: the JSON formats of the web
+    API and a small zotero.sqlite built in memory. The load itself is left
+    out, so they need no database: python -m pytest tests
+'''
+
+import json, os, sqlite3, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zot_sync import seed
+
+# The tables and columns of zotero.sqlite that _SqliteLibrary reads
+ZOTERO_TABLES = """
+CREATE TABLE items (itemID INTEGER PRIMARY KEY, itemTypeID INT, libraryID INT, key TEXT, version INT, synced INT, dateAdded TEXT, dateModified TEXT);
+CREATE TABLE itemTypesCombined (itemTypeID INT, typeName TEXT);
+CREATE TABLE fieldsCombined (fieldID INT, fieldName TEXT);
+CREATE TABLE itemDataValues (valueID INT, value TEXT);
+CREATE TABLE itemData (itemID INT, fieldID INT, valueID INT);
+CREATE TABLE creators (creatorID INT, firstName TEXT, lastName TEXT, fieldMode INT);
+CREATE TABLE creatorTypes (creatorTypeID INT, creatorType TEXT);
+CREATE TABLE itemCreators (itemID INT, creatorID INT, creatorTypeID INT, orderIndex INT);
+CREATE TABLE tags (tagID INT, name TEXT);
+CREATE TABLE itemTags (itemID INT, tagID INT, type INT);
+CREATE TABLE collections (collectionID INT, collectionName TEXT, parentCollectionID INT, libraryID INT, key TEXT, version INT, synced INT);
+CREATE TABLE collectionItems (collectionID INT, itemID INT, orderIndex INT);
+CREATE TABLE relationPredicates (predicateID INT, predicate TEXT);
+CREATE TABLE itemRelations (itemID INT, predicateID INT, object TEXT);
+CREATE TABLE itemNotes (itemID INT, parentItemID INT, note TEXT, title TEXT);
+CREATE TABLE charsets (charsetID INT, charset TEXT);
+CREATE TABLE itemAttachments (itemID INT, parentItemID INT, linkMode INT, contentType TEXT, charsetID INT, path TEXT, storageModTime INT, storageHash TEXT);
+CREATE TABLE itemAnnotations (itemID INT, parentItemID INT, type INT, text TEXT, comment TEXT, color TEXT, pageLabel TEXT, sortIndex TEXT, position TEXT);
+CREATE TABLE deletedItems (itemID INT, dateDeleted TEXT);
+CREATE TABLE savedSearches (savedSearchID INT, savedSearchName TEXT, libraryID INT, key TEXT, version INT, synced INT);
+CREATE TABLE savedSearchConditions (savedSearchID INT, searchConditionID INT, condition TEXT, operator TEXT, value TEXT);
+"""
+
+ZOTERO_ROWS = """
+INSERT INTO itemTypesCombined VALUES (1, 'book'), (2, 'note'), (3, 'attachment'), (4, 'annotation');
+INSERT INTO items VALUES
+    (1, 1, 1, 'BOOK0001', 5, 1, '2020-01-01 10:00:00', '2020-01-02 10:00:00'),
+    (2, 2, 1, 'NOTE0001', 6, 1, '2020-01-01 10:00:00', '2020-01-01 10:00:00'),
+    (3, 3, 1, 'ATTA0001', 7, 1, '2020-01-01 10:00:00', '2020-01-01 10:00:00'),
+    (4, 4, 1, 'ANNO0001', 8, 1, '2020-01-01 10:00:00', '2020-01-01 10:00:00'),
+    (5, 1, 1, 'LOCAL001', 0, 0, '2020-01-01 10:00:00', '2020-01-01 10:00:00'),
+    (6, 1, 1, 'TRASH001', 9, 1, '2020-01-01 10:00:00', '2020-01-01 10:00:00'),
+    (7, 1, 2, 'OTHER001', 3, 1, '2020-01-01 10:00:00', '2020-01-01 10:00:00');
+INSERT INTO fieldsCombined VALUES (1, 'title'), (2, 'date');
+INSERT INTO itemDataValues VALUES (1, 'A book'), (2, '2020-03-00 March 2020'), (3, 'Thrown away');
+INSERT INTO itemData VALUES (1, 1, 1), (1, 2, 2), (6, 1, 3);
+INSERT INTO creators VALUES (1, 'John', 'Doe', 0), (2, '', 'ACME', 1);
+INSERT INTO creatorTypes VALUES (1, 'author'), (2, 'editor');
+INSERT INTO itemCreators VALUES (1, 1, 1, 0), (1, 2, 2, 1);
+INSERT INTO tags VALUES (1, 'history'), (2, 'automatic');
+INSERT INTO itemTags VALUES (1, 1, 0), (1, 2, 1);
+INSERT INTO collections VALUES (1, 'Reading', NULL, 1, 'COLL0001', 4, 1), (2, 'Unsynced', 1, 1, 'COLL0002', 0, 0);
+INSERT INTO collectionItems VALUES (1, 1, 0);
+INSERT INTO relationPredicates VALUES (1, 'dc:relation');
+INSERT INTO itemRelations VALUES (1, 1, 'http://zotero.org/groups/1/items/X'), (1, 1, 'http://zotero.org/groups/1/items/Y');
+INSERT INTO itemNotes VALUES (2, 1, '<p>A note</p>', 'A note');
+INSERT INTO itemAttachments VALUES (3, 1, 0, 'application/pdf', NULL, 'storage:a.pdf', 1577836800000, '0123456789abcdef0123456789abcdef');
+INSERT INTO itemAnnotations VALUES (4, 3, 1, 'quoted', 'a comment', '#ffd400', '12', '00011|001234|00056', '{"pageIndex": 11}');
+INSERT INTO deletedItems VALUES (6, '2020-01-03 10:00:00');
+INSERT INTO savedSearches VALUES (1, 'Unread', 1, 'SRCH0001', 3, 1);
+INSERT INTO savedSearchConditions VALUES (1, 0, 'tag', 'isNot', 'read');
+"""
+
+SCHEMA = { 'itemTypes': [ { 'itemType': 'book', 'fields': [ { 'field': 'title' }, { 'field': 'date' } ],
+    'creatorTypes': [ { 'creatorType': 'author', 'primary': True }, { 'creatorType': 'editor' } ] } ] }
+
+@pytest.fixture
+def library() :
+    sqlite = sqlite3.connect(':memory:')
+    sqlite.executescript(ZOTERO_TABLES + ZOTERO_ROWS)
+    yield seed._SqliteLibrary(sqlite, 1, SCHEMA)
+    sqlite.close()
+
+def test_sqlite_items_in_the_shape_of_the_api(library) :
+    items = { item['key']: item for item in library.items() }
+    assert sorted(items) == ['ANNO0001', 'ATTA0001', 'BOOK0001', 'NOTE0001', 'TRASH001']
+    assert library.unsynced == 1
+    book = items['BOOK0001']
+    assert book['version'] == 5
+    assert book['data']['title'] == 'A book' and book['data']['date'] == 'March 2020'
+    assert book['data']['dateModified'] == '2020-01-02T10:00:00Z'
+    assert book['data']['creators'] == [ { 'creatorType': 'author', 'firstName': 'John', 'lastName': 'Doe' },
+                                         { 'creatorType': 'editor', 'name': 'ACME' } ]
+    assert book['data']['tags'] == [ { 'tag': 'history' }, { 'tag': 'automatic', 'type': 1 } ]
+    assert book['data']['collections'] == ['COLL0001']
+    assert book['data']['relations'] == { 'dc:relation': [ 'http://zotero.org/groups/1/items/X', 'http://zotero.org/groups/1/items/Y' ] }
+    assert book['meta'] == { 'parsedDate': '2020-03', 'numChildren': 2, 'creatorSummary': 'Doe' }
+    assert 'deleted' not in book['data'] and items['TRASH001']['data']['deleted'] is True
+
+def test_sqlite_child_items(library) :
+    items = { item['key']: item for item in library.items() }
+    note = items['NOTE0001']['data']
+    assert note['note'] == '<p>A note</p>' and note['parentItem'] == 'BOOK0001'
+    attachment = items['ATTA0001']['data']
+    assert attachment['parentItem'] == 'BOOK0001' and attachment['linkMode'] == 'imported_file'
+    assert attachment['filename'] == 'a.pdf' and attachment['md5'] == '0123456789abcdef0123456789abcdef'
+    assert attachment['mtime'] == 1577836800000
+    annotation = items['ANNO0001']['data']
+    assert annotation['parentItem'] == 'ATTA0001' and annotation['annotationType'] == 'highlight'
+    assert annotation['annotationText'] == 'quoted' and annotation['annotationPageLabel'] == '12'
+
+def test_sqlite_objects(library) :
+    objects = library.objects()
+    assert [ c['key'] for c in objects['collections'] ] == ['COLL0001']
+    assert objects['collections'][0]['data']['parentCollection'] is False
+    assert objects['collections'][0]['meta'] == { 'numCollections': 1, 'numItems': 1 }
+    assert objects['searches'] == [ { 'key': 'SRCH0001', 'version': 3, 'data': { 'key': 'SRCH0001', 'version': 3,
+        'name': 'Unread', 'conditions': [ { 'condition': 'tag', 'operator': 'isNot', 'value': 'read' } ] } } ]
+    assert sorted(objects['tags']) == ['automatic', 'history']
+
+@pytest.fixture
+def seeded(monkeypatch) :
+    calls = []
+    monkeypatch.setattr(seed, 'seed_library', lambda *args, **kwargs : calls.append(args))
+    return calls
+
+def _api_item(key, version, **data) :
+    return { 'key': key, 'version': version, 'library': { 'type': 'group', 'id': 12, 'name': 'A group' },
+             'data': dict(data, key=key, version=version, itemType='book') }
+
+def test_json_array_of_api_items(tmp_path, seeded) :
+    path = tmp_path / 'items.json'
+    path.write_text(json.dumps([ _api_item('AAAAAAAA', 3), _api_item('BBBBBBBB', 5) ]))
+    seed.from_json(None, str(path))
+    engine, library_type_id, library_name, library_version, items = seeded[0]
+    assert (library_type_id, library_name, library_version) == ('zot_g_12', 'A group', 5)
+    assert [ item['key'] for item in items ] == ['AAAAAAAA', 'BBBBBBBB']
+
+def test_json_lines_of_item_data(tmp_path, seeded) :
+    path = tmp_path / 'items.jsonl'
+    path.write_text('\n'.join(json.dumps(_api_item(k, v)['data']) for k,v in (('AAAAAAAA', 3), ('BBBBBBBB', 5))) + '\n\n')
+    # Bare item data does not name its library
+    with pytest.raises(ValueError) :
+        seed.from_json(None, str(path))
+    seed.from_json(None, str(path), 7, 'user', 4)
+    engine, library_type_id, library_name, library_version, items = seeded[0]
+    assert (library_type_id, library_version) == ('zot_u_7', 4)
+    assert items[1] == { 'key': 'BBBBBBBB', 'version': 5, 'data': { 'key': 'BBBBBBBB', 'version': 5, 'itemType': 'book' } }
+
+def test_json_without_items(tmp_path, seeded) :
+    path = tmp_path / 'items.json'
+    path.write_text(' []')
+    with pytest.raises(ValueError) :
+        seed.from_json(None, str(path), 7, 'user')
@@ -0,0 +1,93 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+''' Tests of the statements zot_sync.store builds, against a stand-in
+    connection that records them. They need no database: python -m pytest tests
+'''
+
+import os, re, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zot_sync import store
+
+class _Result(object):
+    def __init__(self, rows) :
+        self.rows = rows
+
+    def fetchall(self) :
+        return self.rows
+
+class _Database(object):
+    ''' Records executed statements with their parameters and answers each with `rows`.
+    '''
+    def __init__(self, rows = ()) :
+        self.rows = list(rows)
+        self.statements = []
+
+    def execute(self, query, **params) :
+        self.statements.append((str(query), params))
+        return _Result(self.rows)
+
+def _values(statement) :
+    return re.findall(r'\( (?:(?::p\d+_\d+|DEFAULT)(?:, )?)+ \)', statement)
+
+def test_upsert_writes_column_union_with_defaults() :
+    db = _Database([('AAAAAAAA', True), ('BBBBBBBB', False)])
+    rows = [ { 'key': 'AAAAAAAA', 'version': 1, 'title': 'A book' },
+             { 'key': 'BBBBBBBB', 'version': 2, 'publisher': 'ACME' } ]
+    assert store.upsert_items(db, 'zot_g_1', rows) == (1, 1)
+    assert len(db.statements) == 1
+    statement, params = db.statements[0]
+    assert 'INSERT INTO zot_g_1.items ("key", "version", "title", "publisher")' in statement
+    assert _values(statement) == [ '( :p0_0, :p0_1, :p0_2, DEFAULT )', '( :p1_0, :p1_1, DEFAULT, :p1_3 )' ]
+    assert params == { 'p0_0': 'AAAAAAAA', 'p0_1': 1, 'p0_2': 'A book', 'p1_0': 'BBBBBBBB', 'p1_1': 2, 'p1_3': 'ACME' }
+    assert 'ON CONFLICT (key) DO UPDATE SET "version"=EXCLUDED."version", "title"=EXCLUDED."title", "publisher"=EXCLUDED."publisher"' in statement
+
+def test_encoded_rows_share_one_template_per_item_type() :
+    db = _Database([('AAAAAAAA', True), ('BBBBBBBB', True), ('CCCCCCCC', True)])
+    book = ('key', 'version', 'title')
+    note = ('key', 'version', 'note')
+    rows = [ (book, ('AAAAAAAA', 1, 'A book')), (note, ('BBBBBBBB', 2, 'A note')), (book, ('CCCCCCCC', 3, None)) ]
+    assert store.upsert_items(db, 'zot_g_1', rows) == (3, 0)
+    statement, params = db.statements[0]
+    assert 'INSERT INTO zot_g_1.items ("key", "version", "title", "note")' in statement
+    assert _values(statement) == [ '( :p0_0, :p0_1, :p0_2, DEFAULT )', '( :p1_0, :p1_1, DEFAULT, :p1_3 )', '( :p2_0, :p2_1, :p2_2, DEFAULT )' ]
+    assert params['p1_3'] == 'A note' and params['p2_2'] is None
+
+def test_upsert_logs_changes_in_the_same_statement() :
+    db = _Database([('AAAAAAAA', True), ('BBBBBBBB', False)])
+    rows = [ { 'key': 'AAAAAAAA', 'version': 1 }, { 'key': 'BBBBBBBB', 'version': 2 } ]
+    assert store.upsert_items(db, 'zot_g_1', rows, 7) == (1, 1)
+    assert len(db.statements) == 1
+    statement, params = db.statements[0]
+    assert 'INSERT INTO logs.zot_changes' in statement
+    assert params['changes_sync_id'] == 7 and params['changes_library'] == 'zot_g_1'
+
+def test_insert_into_staging_without_conflict() :
+    db = _Database()
+    rows = [ { 'key': 'AAAAAAAA', 'version': 1 }, { 'key': 'BBBBBBBB', 'version': 2, 'title': 'A book' } ]
+    assert store.insert_items(db, 'zot_g_1', rows) == (2, 0)
+    statement, params = db.statements[0]
+    assert 'INSERT INTO zot_g_1.items_staging ("key", "version", "title")' in statement
+    assert 'ON CONFLICT' not in statement and 'RETURNING' not in statement
+    assert _values(statement) == [ '( :p0_0, :p0_1, DEFAULT )', '( :p1_0, :p1_1, :p1_2 )' ]
+
+def test_upsert_of_no_rows_sends_nothing() :
+    db = _Database()
+    assert store.upsert_items(db, 'zot_g_1', []) == (0, 0)
+    assert db.statements == []
+
+def test_delete_items_in_one_statement() :
+    db = _Database([('AAAAAAAA',)])
+    assert store.delete_items(db, 'zot_g_1', ['AAAAAAAA', 'BBBBBBBB']) == ['AAAAAAAA']
+    assert len(db.statements) == 1
+    assert db.statements[0][1]['keys'] == ['AAAAAAAA', 'BBBBBBBB']
+    assert store.delete_items(db, 'zot_g_1', []) == []
+    assert len(db.statements) == 1
+
+def test_delete_logs_changes_in_the_same_statement() :
+    db = _Database([('AAAAAAAA',)])
+    assert store.delete_items(db, 'zot_g_1', ['AAAAAAAA'], 7) == ['AAAAAAAA']
+    assert len(db.statements) == 1
+    statement, params = db.statements[0]
+    assert 'INSERT INTO logs.zot_changes' in statement
+    assert params['sync_id'] == 7 and params['lib'] == 'zot_g_1'
@@ -0,0 +1,219 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import datetime, email.utils, os, threading, time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Can be pointed at a local stand-in of the Zotero web API
+base_url = os.environ.get('ZOTERO_API_URL', 'https://api.zotero.org')
+
+RATE = 10           # requests per second, shared by all threads
+BURST = 10
+MAX_RETRIES = 5
+TIMEOUT = (10, 60)  # seconds to connect, and to wait for the next bytes of a response
+
+class ZoteroError(Exception):
+    ''' Error response from the Zotero API. The message starts like pyzotero's,
+        so the status code is found at str(e)[7:10].
+    '''
+    def __init__(self, response):
+        self.response = response
+        super().__init__("\nCode: %s\nURL: %s\nMethod: %s\nResponse: %s" % (
+            response.status_code, response.url, response.request.method, response.text))
+
+class Scheduler(object):
+    ''' Token bucket for all requests of this process.
+        A Backoff or Retry-After header from the server pauses every thread.
+    '''
+    def __init__(self, rate = RATE, burst = BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True :
+            with self.lock :
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if now >= self.paused_until and self.tokens >= 1 :
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def backoff(self, seconds):
+        with self.lock :
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+scheduler = Scheduler()
+
+# One keep-alive connection pool for all libraries and threads
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.headers.update({ 'Zotero-API-Version': '3', 'Accept-Encoding': 'gzip' })
+
+def _seconds(value, default):
+    """ Seconds to wait from a Retry-After or Backoff header, which gives
+        either a number of seconds or an HTTP date.
+    """
+    if value is None :
+        return default
+    try :
+        return max(0, int(value))
+    except ValueError :
+        pass
+    try :
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError) :
+        return default
+    if when.tzinfo is None :
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def configure(rate = None, url = None):
+    global base_url
+    if rate :
+        scheduler.rate = rate
+        scheduler.burst = max(1, rate)
+    if url :
+        base_url = url
+
+def get(path, params = None, headers = None, api_key = None, stats = None, stream = False):
+    """ GET a path of the Zotero API through the shared session and scheduler.
+        429 and 503 responses are retried after the time the server asks for,
+        dropped and stalled connections (see TIMEOUT) after an exponential delay.
+        Returns the response for 200, 206 and 304, raises ZoteroError otherwise.
+        With `stream` the body is left to be read by the caller.
+        Request time, bytes and retries are counted in `stats` if given.
+    """
+    headers = dict(headers or {})
+    if api_key :
+        headers['Zotero-API-Key'] = api_key
+    if params :
+        params = { k: v for k,v in params.items() if v is not None }
+    url = path if path.startswith('http') else base_url + path
+    for attempt in range(MAX_RETRIES + 1) :
+        if attempt > 0 and stats is not None :
+            stats.add(retries=1)
+        scheduler.wait()
+        start = time.perf_counter()
+        try :
+            response = session.get(url, params=params, headers=headers, stream=stream, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) :
+            if attempt == MAX_RETRIES :
+                raise
+            time.sleep(2**attempt)
+            continue
+        if stats is not None :
+            size = int(response.headers.get('Content-Length', 0 if stream else len(response.content)))
+            stats.add(requests=1, request_seconds=time.perf_counter() - start, bytes_received=size)
+        if 'Backoff' in response.headers :
+            scheduler.backoff(_seconds(response.headers['Backoff'], 0))
+        if response.status_code in (429, 503) and attempt < MAX_RETRIES :
+            scheduler.backoff(_seconds(response.headers.get('Retry-After'), 2**attempt))
+            response.close()
+            continue
+        if response.status_code in (200, 206, 304) :
+            return response
+        raise ZoteroError(response)
+
+class Library(object):
+    ''' Read access to one user or group library, similar to pyzotero.Zotero.
+        The last response is kept in `request` for its headers.
+    '''
+    def __init__(self, library_id, library_type, api_key = None, stats = None):
+        self.library_id = library_id
+        self.library_type = library_type
+        self.api_key = api_key
+        self.stats = stats
+        self.prefix = '/%ss/%s' % ('user' if library_type[:1] == 'u' else 'group', library_id)
+        self.request = None
+
+    def _get(self, path, modified_since = None, **params):
+        headers = { 'If-Modified-Since-Version': str(modified_since) } if modified_since is not None else None
+        self.request = get(self.prefix + path, params, headers, api_key=self.api_key, stats=self.stats)
+        return self.request
+
+    def _get_all(self, path, **params):
+        """ Follow the Link headers of a multi-page response and join the pages.
+        """
+        results = self._get(path, **params).json()
+        while 'next' in self.request.links :
+            self.request = get(self.request.links['next']['url'], api_key=self.api_key, stats=self.stats)
+            results += self.request.json()
+        return results
+
+    def items(self, **params):
+        """ Items as JSON, {key: version} with format='versions' or keys with format='keys'.
+            With modified_since=<version> an unchanged library answers 304,
+            which leaves request.status_code at 304 and returns nothing.
+        """
+        response = self._get('/items', **params)
+        if response.status_code == 304 :
+            return None
+        if params.get('format') == 'keys' :
+            return response.text.split()
+        return response.json()
+
+    def fulltext(self, since = 0):
+        """ {key: version} of the attachments whose full-text content changed since a version.
+        """
+        return self._get('/fulltext', since=since).json()
+
+    def item_fulltext(self, key):
+        """ Full-text content of an attachment with its page or character counts,
+            None if the attachment has none.
+        """
+        try :
+            return self._get('/items/%s/fulltext' % key).json()
+        except ZoteroError as e :
+            if e.response.status_code == 404 :
+                return None
+            raise
+
+    def file(self, key, offset = 0):
+        """ Streaming response with the stored file of an attachment, from byte
+            `offset` on (status 206 if the server honours the range), None if
+            the attachment has no file or it may not be downloaded (404, 403). The download is redirected to storage
+            and sent unencoded, so byte ranges refer to the file itself.
+        """
+        headers = { 'Accept-Encoding': 'identity' }
+        if offset :
+            headers['Range'] = 'bytes=%i-' % offset
+        try :
+            self.request = get(self.prefix + '/items/%s/file' % key, headers=headers,
+                               api_key=self.api_key, stats=self.stats, stream=True)
+        except ZoteroError as e :
+            if e.response.status_code in (403, 404) :
+                return None
+            raise
+        return self.request
+
+    def deleted(self, since):
+        return self._get('/deleted', since=since).json()
+
+    def collections(self, since = 0):
+        return self._get_all('/collections', since=since, limit=100)
+
+    def searches(self, since = 0):
+        return self._get_all('/searches', since=since, limit=100)
+
+    def tags(self, since = 0):
+        return [ t['tag'] for t in self._get_all('/tags', since=since, limit=100) ]
+
+    def groups(self):
+        self.request = get('/users/%s/groups' % self.library_id, { 'limit': 100 }, api_key=self.api_key)
+        results = self.request.json()
+        while 'next' in self.request.links :
+            self.request = get(self.request.links['next']['url'], api_key=self.api_key)
+            results += self.request.json()
+        return results
+
+def key_info(api_key):
+    return get('/keys/%s' % api_key).json()
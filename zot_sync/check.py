@@ -1,8 +1,7 @@
 # https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
 
-from pyzotero.zotero import Zotero
+from . import api
 
 def key_info(api_key, verbose = False):
     print('checking API key properties...')
-    z = Zotero('AnyLibrary', 'AnyType', api_key)
-    return z.key_info(limit=None)
+    return api.key_info(api_key)
@@ -0,0 +1,136 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import json, re
+
+from . import schema as _schema
+
+_json_in_note = re.compile(r'{.*}')
+
+def _text(value) :
+    return None if value == '' else value
+
+def _json(value) :
+    return json.dumps(value) if value else None
+
+def _bool(value) :
+    return bool(value)
+
+def _note_json(note) :
+    match = _json_in_note.search(note or '')
+    if match is None :
+        return None
+    try :
+        return json.loads(match.group(0))
+    except ValueError :
+        return None
+
+def _custom_json(note) :
+    value = _note_json(note)
+    return None if value is None else json.dumps(value)
+
+_meta_columns = ('numChildren', 'createdByUser', 'lastModifiedByUser', 'parsedDate', 'creatorSummary')
+_common_data_columns = ('key', 'version', 'itemType', 'dateAdded', 'dateModified', 'deleted',
+                        'creators', 'tags', 'collections', 'relations', 'parentItem')
+
+class Encoder(object):
+    ''' Turns API items of one item type into column-ordered tuples for <lib>.items.
+        The plan of (field, converter) pairs is built once from the schema, so
+        encoding an item is two list comprehensions. Fields of the type that
+        an item lacks are written as NULL (deleted as FALSE), so a row always
+        carries the full state of its item.
+    '''
+    def __init__(self, item_type, fields, column_types) :
+        def _converter(column) :
+            type = column_types[column]
+            if column == 'deleted' :
+                return _bool
+            elif type == 'jsonb' :
+                return _json
+            else :
+                return _text
+        data_plan = {}
+        for field in _common_data_columns :
+            data_plan[field] = (field, _converter(field))
+        if item_type == 'attachment' :
+            child_fields = list(_schema._child_fields())
+        elif item_type == 'annotation' :
+            child_fields = ['parentItem'] + list(_schema._annotation_fields())
+        else :
+            child_fields = ['parentItem'] if item_type in _schema._child_item_types else []
+        for field in child_fields :
+            data_plan[field] = (field, _converter(field))
+        for field,column in fields.items() :
+            if column in column_types and column not in _meta_columns and column != 'customJSON' :
+                data_plan[column] = (field, _converter(column))
+        self.custom_json = 'customJSON' in fields and 'customJSON' in column_types
+        self.data_plan = list(data_plan.values())
+        self.meta_plan = [ (field, _converter(field)) for field in _meta_columns ]
+        self.columns = tuple(data_plan) + _meta_columns + (('customJSON',) if self.custom_json else ())
+
+    def encode(self, item) :
+        data = item['data']
+        meta = item.get('meta', {})
+        row = [ convert(data.get(field)) for field,convert in self.data_plan ]
+        row += [ convert(meta.get(field)) for field,convert in self.meta_plan ]
+        if self.custom_json :
+            row.append(_custom_json(data.get('note')))
+        return tuple(row)
+
+class CompactEncoder(object):
+    ''' Turns API items of one item type into rows of the compact layout:
+        the hot columns are typed, everything else of item['data'] goes
+        into the jsonb column "data" and the API's meta into "meta".
+        The field stored in the title column (e.g. note or caseName) is not
+        repeated in "data".
+    '''
+    def __init__(self, item_type, fields) :
+        self.title_field = next((field for field,column in fields.items() if column == 'title'), 'title')
+        self.custom_json = 'customJSON' in fields
+        self.hot = set(_schema.COMPACT_COLUMNS) | { self.title_field }
+        self.columns = _schema.COMPACT_COLUMNS + ('data', 'meta')
+
+    def encode(self, item) :
+        data = item['data']
+        meta = dict(item.get('meta', {}))
+        if self.custom_json :
+            custom_json = _note_json(data.get('note'))
+            if custom_json is not None :
+                meta['customJSON'] = custom_json
+        rest = { field: value for field,value in data.items() if field not in self.hot }
+        return (data.get('key'), data.get('version'), data.get('itemType'), _text(data.get('dateAdded')),
+                _text(data.get('dateModified')), _bool(data.get('deleted')), _text(data.get(self.title_field)),
+                _text(data.get('parentItem')), json.dumps(rest), json.dumps(meta))
+
+class Encoders(object):
+    ''' One Encoder per item type of a schema and layout, built on first use.
+        Item types the schema does not know yet get the common columns only.
+    '''
+    def __init__(self, schema, layout = 'wide') :
+        self.schema = schema
+        self.fields = _schema.columns_by_item_type(schema)
+        self.column_types = _schema.item_columns(schema)
+        self.layout = layout
+        self.encoders = {}
+
+    def encode(self, item) :
+        """ Return (columns, values) of an API item.
+        """
+        item_type = item['data']['itemType']
+        encoder = self.encoders.get(item_type)
+        if encoder is None :
+            if self.layout == 'compact' :
+                encoder = CompactEncoder(item_type, self.fields.get(item_type, {}))
+            else :
+                encoder = Encoder(item_type, self.fields.get(item_type, {}), self.column_types)
+            self.encoders[item_type] = encoder
+        return (encoder.columns, encoder.encode(item))
+
+_cache = {}
+
+def for_schema(schema, layout = 'wide') :
+    """ Return the Encoders of a schema and layout, shared by all libraries using them.
+    """
+    encoders = _cache.get(layout)
+    if encoders is None or encoders.schema is not schema :
+        encoders = _cache[layout] = Encoders(schema, layout)
+    return encoders
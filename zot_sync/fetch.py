@@ -1,12 +1,18 @@
 # https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
 
-import datetime, json, math, os, re
+import collections, datetime, functools, itertools, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from sqlalchemy import text
-from pyzotero.zotero import Zotero
 
+from . import api
+from . import encode
+from . import files
+from . import metrics
 from . import schema
 from . import check
+from . import store
 
 def _duration(start_time) :
     return (datetime.datetime.now(datetime.timezone.utc)-start_time).total_seconds()
@@ -14,46 +20,318 @@ def _duration(start_time) :
 def _start_duration() :
     return datetime.datetime.now(datetime.timezone.utc)
 
-def from_zotero_user(engine, user_id, api_key = None, verbose = False) :
-    from_zotero_library(engine, user_id, 'user', api_key, verbose)
+PAGE_SIZE = 100
+KEY_BATCH_SIZE = 50
+PAGE_WORKERS = 4
+FULLTEXT_WORKERS = 4
+FULLTEXT_BATCH = 50
+FILE_WORKERS = 4
+FILE_BATCH = 50
 
-def from_zotero_group(engine, group_id, api_key = None, verbose = False):
-    from_zotero_library(engine, group_id, 'group', api_key, verbose)
+def _pages(z, library_id, library_type, api_key = None, since = 0, start = 0, workers = PAGE_WORKERS) :
+    """ Yield (page, total_results) for all items, top-level and child items,
+        modified since a version,
+        beginning at offset `start`. The first page is fetched with the given
+        library client and tells how many pages remain; those are prefetched.
+    """
+    first_page = z.items(limit=PAGE_SIZE, start=start, format='json', since=since, includeTrashed=1)
+    total_results = int(z.request.headers.get('Total-Results', 0))
+    yield (first_page, total_results)
+    if len(first_page) < PAGE_SIZE :
+        return
+    def _fetch_page(z, start) :
+        return z.items(limit=PAGE_SIZE, start=start, format='json', since=since, includeTrashed=1)
+    offsets = range(start+PAGE_SIZE, total_results, PAGE_SIZE)
+    for page in _prefetch(_fetch_page, offsets, library_id, library_type, api_key, workers, z.stats) :
+        yield (page, total_results)
+
+def _pages_by_keys(library_id, library_type, api_key, keys, workers = PAGE_WORKERS, stats = None) :
+    """ Yield pages of the given items, requested by itemKey in batches of 50.
+    """
+    def _fetch_batch(z, batch) :
+        return z.items(itemKey=','.join(batch), limit=KEY_BATCH_SIZE, format='json', includeTrashed=1)
+    batches = ( keys[i:i+KEY_BATCH_SIZE] for i in range(0, len(keys), KEY_BATCH_SIZE) )
+    return _prefetch(_fetch_batch, batches, library_id, library_type, api_key, workers, stats)
+
+def _prefetch(fetch, arguments, library_id, library_type, api_key = None, workers = PAGE_WORKERS, stats = None) :
+    """ Yield fetch(z, argument) for every argument, in order.
+        Requests are run by a bounded thread pool while the caller writes
+        earlier results to the database; at most 2*workers results are held
+        in memory at any time.
+    """
+    # The client keeps the last response on the instance, so every thread gets its own
+    local = threading.local()
+    def _fetch(argument) :
+        if not hasattr(local, 'z') :
+            local.z = api.Library(library_id, library_type, api_key, stats)
+        return fetch(local.z, argument)
+    arguments = iter(arguments)
+    with ThreadPoolExecutor(max_workers=workers) as pool :
+        pending = collections.deque()
+        for argument in itertools.islice(arguments, 2*workers) :
+            pending.append(pool.submit(_fetch, argument))
+        try :
+            while pending :
+                result = pending.popleft().result()
+                for argument in itertools.islice(arguments, 1) :
+                    pending.append(pool.submit(_fetch, argument))
+                yield result
+        finally :
+            for future in pending :
+                future.cancel()
+
+def from_zotero_user(engine, user_id, api_key = None, verbose = False, full = False, files_directory = None) :
+    return from_zotero_library(engine, user_id, 'user', api_key, verbose, full, files_directory)
+
+def from_zotero_group(engine, group_id, api_key = None, verbose = False, full = False, files_directory = None):
+    return from_zotero_library(engine, group_id, 'group', api_key, verbose, full, files_directory)
+
+def from_libraries(engine, libraries, api_key = None, verbose = False, jobs = 1, full = False, files_directory = None) :
+    """ Sync a list of (library_id, library_type) tuples.
+        With jobs > 1 the libraries are synced concurrently, each with its own
+        connection from the engine's pool. Failures are logged per library by
+        from_zotero_library and do not stop the other libraries.
+    """
+    if jobs > 1 :
+        with ThreadPoolExecutor(max_workers=jobs) as pool :
+            results = list(pool.map(lambda l : from_zotero_library(engine, l[0], l[1], api_key, verbose, full, files_directory), libraries))
+    else :
+        results = [ from_zotero_library(engine, l[0], l[1], api_key, verbose, full, files_directory) for l in libraries ]
+    _print_summary(libraries, results)
+    return results
+
+def _print_summary(libraries, results) :
+    if len(libraries) < 2 :
+        return
+    print("Summary of %i libraries:" % len(libraries))
+    for (library_id, library_type),result in zip(libraries, results) :
+        if result is None :
+            print("  %s %i: aborted or skipped" % (library_type, library_id))
+        elif result['duration'] > 0 :
+            print("  %s: %i items written, %i deleted in %.1f seconds (%.1f items/s)" % (
+                result['library'], result['written'], result['deleted'], result['duration'], result['written']/result['duration']))
+        else :
+            print("  %s: %i items written, %i deleted" % (result['library'], result['written'], result['deleted']))
 
-def from_all_groups_by_user(engine, user_id = None, api_key = None, only_groups = False, verbose = False):
+def from_all_groups_by_user(engine, user_id = None, api_key = None, only_groups = False, verbose = False, jobs = 1, full = False, files_directory = None):
     try:
-        _from_all_groups_by_user(engine, user_id, api_key, only_groups, verbose)
+        _from_all_groups_by_user(engine, user_id, api_key, only_groups, verbose, jobs, full, files_directory)
     except Exception as e:
         print("\nsome error has occurred ¶")
 
-def _from_all_groups_by_user(engine, user_id = None, api_key = None, only_groups = False, verbose = False):
-    z = Zotero(user_id, 'user', api_key)
-    groups = z.groups()
-    for group in groups :
-        from_zotero_group(engine, group['id'], api_key, verbose)
+def groups_by_user(user_id, api_key = None) :
+    z = api.Library(user_id, 'user', api_key)
+    return [ (group['id'], 'group') for group in z.groups() ]
+
+def _from_all_groups_by_user(engine, user_id = None, api_key = None, only_groups = False, verbose = False, jobs = 1, full = False, files_directory = None):
+    from_libraries(engine, groups_by_user(user_id, api_key), api_key, verbose, jobs, full, files_directory)
 
-def from_all_by_key(engine, api_key, only_groups = False, verbose = False):
+def from_all_by_key(engine, api_key, only_groups = False, verbose = False, jobs = 1, full = False, files_directory = None):
     try:
-        _from_all_by_key(engine, api_key, only_groups, verbose)
+        _from_all_by_key(engine, api_key, only_groups, verbose, jobs, full, files_directory)
     except Exception as e:
         print("\ninvalid API key starting with %s ¶" % api_key[:3])
 
-def _from_all_by_key(engine, api_key, only_groups = False, verbose = False):
+def _from_all_by_key(engine, api_key, only_groups = False, verbose = False, jobs = 1, full = False, files_directory = None):
     key_info = check.key_info(api_key, verbose)
+    from_libraries(engine, libraries_by_key(api_key, only_groups, key_info), api_key, verbose, jobs, full, files_directory)
+    if 'groups' not in key_info['access']:
+        return "no groups to sync for this API key starting with %s" % api_key[:4]
+
+def libraries_by_key(api_key, only_groups = False, key_info = None) :
+    """ Return (library_id, library_type) of every library the API key can read.
+    """
+    if key_info is None :
+        key_info = check.key_info(api_key)
+    libraries = []
     if 'user' in key_info['access'] and not only_groups :
-        from_zotero_user(engine, key_info['userID'], api_key, verbose)
+        libraries.append((key_info['userID'], 'user'))
     if 'user' in key_info['access'] and only_groups :
         print('skipping user library as requested')
     if 'groups' in key_info['access']:
         if 'all' in key_info['access']['groups']:
-            from_all_groups_by_user(engine, key_info['userID'], api_key, only_groups, verbose)
+            libraries += groups_by_user(key_info['userID'], api_key)
         else :
             for group in key_info['access']['groups'] :
-                from_zotero_group(engine, int(group), api_key, verbose)
-    else :
-        return "no groups to sync for this API key starting with %s" % api_key[:4]
+                libraries.append((int(group), 'group'))
+    return libraries
+
+def _sync_objects(z, db, library_type_id, library_version, full = False) :
+    """ Sync collections, saved searches and tags into their own tables.
+        Each kind keeps its own synced version in <lib>.meta, so a kind that
+        failed or was added later catches up independently of the items.
+    """
+    fetchers = {
+        'collections': z.collections,
+        'searches':    z.searches,
+        'tags':        z.tags,
+    }
+    deleted = {}
+    for object,fetch_since in fetchers.items() :
+        since = 0 if full else store.read_object_version(db, library_type_id, object)
+        if since >= library_version :
+            continue
+        start_round = _start_duration()
+        objects = fetch_since(since)
+        if since > 0 and since not in deleted :
+            deleted[since] = z.deleted(since=since)
+        with db.begin() :
+            if since > 0 :
+                removed = store.delete_objects(db, library_type_id, object, deleted[since].get(object, []))
+            else :
+                removed = []
+                store.clear_objects(db, library_type_id, object)
+            if object == 'collections' :
+                store.upsert_collections(db, library_type_id, objects)
+            elif object == 'searches' :
+                store.upsert_searches(db, library_type_id, objects)
+            else :
+                store.upsert_tags(db, library_type_id, objects, library_version)
+            store.write_object_version(db, library_type_id, object, library_version)
+        print("Synced %i %s and deleted %i in %s seconds" % (len(objects), object, len(removed), str(_duration(start_round))))
+
+def _sync_fulltext(z, db, library_type_id, library_version, full = False) :
+    """ Sync the full-text content of attachments into <lib>.fulltext.
+        Like the other objects it keeps its own synced version in <lib>.meta,
+        and only content changed since then is requested, by FULLTEXT_WORKERS
+        threads at a time.
+    """
+    since = 0 if full else store.read_object_version(db, library_type_id, 'fulltext')
+    if since >= library_version :
+        return
+    start_round = _start_duration()
+    versions = z.fulltext(since)
+    def _fetch_fulltext(z, key) :
+        return (key, z.item_fulltext(key))
+    contents = _prefetch(_fetch_fulltext, sorted(versions), z.library_id, z.library_type, z.api_key, FULLTEXT_WORKERS, z.stats)
+    written = 0
+    removed = 0
+    while True :
+        batch = list(itertools.islice(contents, FULLTEXT_BATCH))
+        if not batch :
+            break
+        with db.begin() :
+            written += sum(store.upsert_fulltext(db, library_type_id, { k: c for k,c in batch if c is not None }, versions))
+            removed += len(store.delete_objects(db, library_type_id, 'fulltext', [ k for k,c in batch if c is None ]))
+    with db.begin() :
+        if since == 0 :
+            store.delete_orphaned_fulltext(db, library_type_id)
+        store.write_object_version(db, library_type_id, 'fulltext', library_version)
+    print("Synced full text of %i attachments and removed %i in %s seconds" % (written, removed, str(_duration(start_round))))
+
+def _sync_files(z, db, library_type_id, library_version, files_directory, layout = 'wide', full = False) :
+    """ Download the files of attachments whose md5 or mtime differ from
+        <lib>.files into `files_directory`, by FILE_WORKERS threads
+        at a time. Attachments sharing a file download it once, files stored
+        before (e.g. by another library) are not downloaded at all.
+        A full re-sync checks every attachment against the directory.
+        Attachments without a file to download are recorded with no size.
+        Failed downloads are not recorded, so the next sync that finds the
+        library changed retries them, resuming partial files. The files
+        version advances regardless, one broken attachment must not keep
+        every later sync from skipping an unchanged library.
+    """
+    start_round = _start_duration()
+    attachments = collections.OrderedDict()
+    for key,md5,mtime in store.pending_files(db, library_type_id, layout, full) :
+        attachments.setdefault(md5, []).append((key, mtime))
+    def _fetch_file(z, md5) :
+        try :
+            return (md5, files.download(z, files_directory, attachments[md5][0][0], md5), None)
+        except (files.DownloadError, api.ZoteroError, requests.RequestException, OSError) as e :
+            return (md5, None, e)
+    results = _prefetch(_fetch_file, list(attachments), z.library_id, z.library_type, z.api_key, FILE_WORKERS, z.stats)
+    stored = 0
+    failed = 0
+    while True :
+        batch = list(itertools.islice(results, FILE_BATCH))
+        if not batch :
+            break
+        rows = []
+        for md5,size,error in batch :
+            if error is not None :
+                failed += 1
+                print("Download of %s failed: %s" % (md5, error))
+                continue
+            stored += size is not None
+            rows += [ { 'key': key, 'md5': md5, 'mtime': mtime, 'size': size } for key,mtime in attachments[md5] ]
+        with db.begin() :
+            store.upsert_files(db, library_type_id, rows)
+    with db.begin() :
+        store.delete_orphaned_files(db, library_type_id, layout)
+        store.write_object_version(db, library_type_id, 'files', library_version)
+    print("Stored %i files of attachments and %i failed in %s seconds" % (stored, failed, str(_duration(start_round))))
+
+def verify_library(engine, library_id, library_type, api_key = None, repair = False, verbose = False) :
+    """ Compare the mirror of a library with the cloud: one versions request
+        and one set-based SQL pass report missing, stale and orphaned items.
+        With `repair` only those items are refetched or deleted, logged as a
+        sync with its changes; collections, searches and tags are synced too.
+        Returns the dict of keys by kind of drift.
+    """
+    library_type_id = "zot_%s_%i" % (library_type[:1], library_id)
+    start_time = _start_duration()
+    stats = metrics.Stats(library_type_id)
+    z = api.Library(library_id, library_type, api_key, stats)
+    remote_versions = z.items(limit=None, format='versions', includeTrashed=1)
+    library_version = int(z.request.headers.get('last-modified-version', 0))
+    with engine.connect() as db:
+        if not schema.has_table(db, '%s.items' % library_type_id) :
+            print("%s is not mirrored yet, nothing to verify" % library_type_id)
+            return None
+        found = store.drift(db, library_type_id, remote_versions)
+        print("%s at version %i: %i remote items, %i missing, %i stale and %i orphaned in the mirror (%s seconds)" % (
+            library_type_id, library_version, len(remote_versions),
+            len(found['missing']), len(found['stale']), len(found['orphaned']), str(_duration(start_time))))
+        if verbose :
+            for kind,keys in found.items() :
+                if keys :
+                    print("  %s: %s" % (kind, ' '.join(keys)))
+        if repair and any(found.values()) :
+            item_type_schema = schema.for_library(engine, library_type_id, verbose)
+            layout = schema.library_layout(db, library_type_id)
+            encoders = encode.for_schema(item_type_schema, layout)
+            # Afterwards the items match the library at library_version, so the
+            # repair is logged like a sync and its changes go to the change feed
+            last_sync = store.last_sync(db, library_type_id)
+            sync = store.start_sync(db, library_type_id, last_sync[1] if last_sync else library_type_id)
+            written = 0
+            refetch = found['missing'] + found['stale']
+            for page in _pages_by_keys(library_id, library_type, api_key, refetch, stats=stats) :
+                rows = [ encoders.encode(item) for item in page ]
+                with db.begin() :
+                    written += sum(store.upsert_items(db, library_type_id, rows, sync[0]))
+            # The sync is logged at library_version, which the other kinds in <lib>.meta have to reach as well
+            _sync_objects(z, db, library_type_id, library_version)
+            with db.begin() :
+                deleted = store.delete_items(db, library_type_id, found['orphaned'], sync[0])
+                # Whether the mirror syncs full text or files shows in its tables
+                if schema.has_table(db, '%s.fulltext' % library_type_id) :
+                    store.delete_objects(db, library_type_id, 'fulltext', deleted)
+                if schema.has_table(db, '%s.files' % library_type_id) :
+                    store.delete_orphaned_files(db, library_type_id, layout)
+                store.finish_sync(db, sync[0], library_version, _duration(start_time))
+                store.notify_changes(db, library_type_id, sync[0], last_sync[0] if last_sync else 0, library_version)
+            print("Repaired %s: %i items refetched, %i deleted in %s seconds" % (
+                library_type_id, written, len(deleted), str(_duration(start_time))))
+    return found
+
+def _log_unchanged(engine, library_type_id, last_sync, stats) :
+    """ Log a completed sync of a library that has not changed since the last one.
+    """
+    start_time = _start_duration()
+    library_version, library_name = last_sync
+    with engine.connect() as db, metrics.attached(db, stats) :
+        with db.begin() :
+            sync = store.start_sync(db, library_type_id, library_name)
+            store.finish_sync(db, sync[0], library_version, 0)
+    duration = _duration(start_time)
+    print("\n%s %s ¶\nSync #%i: unchanged at version %i, nothing to sync." % (library_type_id, library_name, sync[0], library_version))
+    metrics.finish(library_type_id, dict(stats.snapshot(), rows_written=0, rows_deleted=0, sync_seconds=duration))
+    return { 'library': library_type_id, 'name': library_name, 'version': library_version,
+             'written': 0, 'deleted': 0, 'duration': duration }
 
-def from_zotero_library(engine, library_id, library_type, api_key = None,  verbose = False):
+def from_zotero_library(engine, library_id, library_type, api_key = None,  verbose = False, full = False, files_directory = None):
     skip = False
     if not library_type[:1] == 'u' and not library_type[:1] == 'g' :
         print("invalid library_type %s" % library_type)
@@ -65,52 +343,68 @@ def from_zotero_library(engine, library_id, library_type, api_key = None,  verbo
         print("Skipping library of type %s with id %i ¶\n" % (library_type, library_id))
         return
     if verbose :
-        _from_zotero_library(engine, library_id, library_type, api_key, verbose)
+        return _from_zotero_library(engine, library_id, library_type, api_key, verbose, full, files_directory)
     try:
-        _from_zotero_library(engine, library_id, library_type, api_key, verbose)
+        return _from_zotero_library(engine, library_id, library_type, api_key, verbose, full, files_directory)
     except Exception as e:
         library_type_id = "%s_%s_%i" % (str(e)[7:10], library_type[:1], library_id)
         print("\n%s ¶" % library_type_id)
         with engine.connect() as db:
-            query = """
-            INSERT INTO logs.zot_fetch (timestamp, library, name)
-            VALUES ( DEFAULT, :lib, :error) RETURNING id,timestamp;
-            """
-            sync = db.execute(text(query), lib=library_type_id, error=str(e)).fetchone() # ( Int, datetime )
+            sync = store.start_sync(db, library_type_id, str(e)) # ( Int, datetime )
             print("Sync #%i was aborted at %s" % (sync[0], sync[1].strftime('%c')) )
 
-def _from_zotero_library(engine, library_id, library_type, api_key = None, verbose = False):
+def _from_zotero_library(engine, library_id, library_type, api_key = None, verbose = False, full = False, files_directory = None):
     library_type_id = "zot_%s_%i" % (library_type[:1], library_id)
 
+    # Setup the Zotero connection through the shared API client
+    stats = metrics.Stats(library_type_id)
+    z = api.Library(library_id, library_type, api_key, stats)
+
+    # The version of the last completed sync validates a conditional request:
+    # an unchanged library answers 304 and needs nothing else.
+    with engine.connect() as db, metrics.attached(db, stats) :
+        last_sync = store.last_sync(db, library_type_id) # ( Int, String ) or None
+        if full :
+            last_sync = None
+        modified_since = last_sync[0] if last_sync else None
+        # Every kind in <lib>.meta that is behind the last sync has to catch up,
+        # changed or not: e.g. objects an import or a repair did not sync, or the
+        # full text and files of a mirror that has just turned them on
+        objects = ['collections', 'searches', 'tags']
+        if schema.fulltext :
+            objects.append('fulltext')
+        if files_directory :
+            objects.append('files')
+        if last_sync and any(store.read_object_version(db, library_type_id, object) < last_sync[0] for object in objects) :
+            modified_since = None
+    z.items(limit=1, format='keys', modified_since=modified_since)
+    if z.request.status_code == 304 :
+        return _log_unchanged(engine, library_type_id, last_sync, stats)
+    remote_count    = int(z.request.headers.get('total-results', 0))
+    library_version = int(z.request.headers.get('last-modified-version', 0))
+
     # Every library gets a separate schema within the database
-    item_type_schema = schema.for_library(engine, library_type_id, verbose)
+    item_type_schema = schema.for_library(engine, library_type_id, verbose, files_directory is not None)
     # returns dictionary of item table fields.
 
-    # Setup the Zotero connection through pyzotero
-    z = Zotero(library_id, library_type, api_key)
     check_access = z.items(limit=1, format="json", includeTrashed=1)
     library_name = check_access[0]['library']['name']
 
     print("\n%s %s ¶" % (library_type_id, library_name))
 
     # Start the engine and fetch items from the cloud!
-    with engine.connect() as db:
+    with engine.connect() as db, metrics.attached(db, stats) :
         # Start sync timer and log attempt to sync.
         # Duration and latest version will be updated when finished.
-        query = """
-        INSERT INTO logs.zot_fetch (timestamp, library, name)
-        VALUES ( DEFAULT, :lib, :name) RETURNING id,timestamp;
-        """
-        sync = db.execute(text(query), lib=library_type_id, name=library_name).fetchone() # ( Int, datetime )
+        sync = store.start_sync(db, library_type_id, library_name) # ( Int, datetime )
         print("Sync #%i was started at %s" % (sync[0], sync[1].strftime('%c')) )
 
         # Get current local library version
-        query = """
-        SELECT version FROM logs.zot_fetch WHERE library='%s' AND duration IS NOT NULL ORDER BY timestamp DESC LIMIT 1;
-        """ % library_type_id
-        res_last_sync_version = db.execute(text(query)).fetchone() # ( Int, ) or None
-        if res_last_sync_version :
-            last_sync_version = res_last_sync_version[0]
+        if full :
+            last_sync_version = 0
+            print("Starting full re-sync of library %s" % library_type_id)
+        elif last_sync :
+            last_sync_version = last_sync[0]
             query = """
             SELECT COUNT(*) FROM %s.items WHERE NOT deleted ;
             """ % library_type_id
@@ -120,98 +414,108 @@ def _from_zotero_library(engine, library_id, library_type, api_key = None, verbo
             last_sync_version = 0
             print("Starting initial sync of library %s" % library_type_id)
 
-        # Get current remote library count and version
-        z.top(limit=1, format='keys')
-        remote_count    = int(z.request.headers.get('total-results', 0))
-        library_version = int(z.request.headers.get('last-modified-version', 0))
         print("remote cloud is at version %i and contains %i items" % (library_version , remote_count))
 
+        # A full re-sync can change the layout and storage of <lib>.items, other syncs keep them
+        layout, storage, staging_columns = schema.rebuild_plan(db, library_type_id, item_type_schema, full)
+
+        written = 0
+        deletions = 0
         if last_sync_version < library_version :
-            # Get list of local item keys and their versions
-            query = """
-            SELECT key,version FROM %s.items ;
-            """ % library_type_id
-            local_versions = dict(db.execute(text(query)).fetchall()) # { String: Int, }
+            encoders = encode.for_schema(item_type_schema, layout)
 
-            def _fetch_updates_and_inserts( start = 0 ) :
-                start_round = _start_duration()
+            # Resume an interrupted sync if the remote library has not moved since
+            checkpoint = store.read_checkpoint(db, library_type_id)
+            if checkpoint and checkpoint['since_version'] == last_sync_version and checkpoint['target_version'] == library_version :
+                print("Resuming interrupted sync #%i at offset %i (%i rows already written)" % (checkpoint['sync_id'], checkpoint['page_start'], checkpoint['rows_written']))
+            else :
+                checkpoint = { 'since_version': last_sync_version, 'target_version': library_version, 'page_start': 0, 'rows_written': 0 }
+            checkpoint['sync_id'] = sync[0]
+
+            # Initial loads and full re-syncs go into a staging table that replaces <lib>.items at the end
+            staging = last_sync_version == 0
+            if staging and checkpoint['page_start'] > 0 and store.staging_count(db, library_type_id) != checkpoint['rows_written'] :
+                print("Staging table of the interrupted sync is incomplete, starting over")
+                checkpoint.update(page_start=0, rows_written=0)
+            if staging and checkpoint['page_start'] == 0 :
+                store.create_staging(db, library_type_id, staging_columns)
+            store.write_checkpoint(db, library_type_id, **checkpoint)
+            # Changes are logged by key, except for reloads of the whole library
+            write_items = store.insert_items if staging else functools.partial(store.upsert_items, sync_id=sync[0])
+            if not staging :
+                store.adopt_changes(db, library_type_id, sync[0])
+
+            def _fetch_updates_and_inserts() :
                 inserts = 0
-                update_list = z.top(limit=100, start=start, format='json', since=last_sync_version, includeTrashed=1)
-                total_results = int(z.request.headers.get('Total-Results'))
-                # Maybe there are only deletions to handle, so checking number of updates to handle
-                if len(update_list) > 0 :
-                    for item in update_list :
-                        data = {}
-                        for field,value in item['data'].items() :
-                            data[field] = schema._typeset_for_db(field, value, item['data']['itemType'])
-                            if field == 'version' :
-                                update_string = '"version"=:version'
-                                insert_field_string = '"key", "version"'
-                                insert_value_string = ':key, :version'
-                            elif field != 'key' :
-                                update_string += ', "%s"=:%s' % (field, field)
-                                insert_field_string += ', "%s"' % field
-                                insert_value_string += ', :%s' % field
-                            if field == 'note' :
-                                data['customJSON'] = schema._typeset_for_db("customJSON", json.loads(re.findall(r'{.*}',value)[0]), "note")
-                                update_string += ', "%s"=:%s' % ("customJSON", "customJSON")
-                                insert_field_string += ', "%s"' % "customJSON"
-                                insert_value_string += ', :%s' % "customJSON"
-                        for field,value in item['meta'].items() :
-                            data[field] = schema._typeset_for_db(field, value, item['data']['itemType'])
-                            update_string += ', "%s"=:%s' % (field, field)
-                            insert_field_string += ', "%s"' % field
-                            insert_value_string += ', :%s' % field
-                        item_type = item['data']['itemType']
-                        if item['key'] in local_versions :
-                            query = """
-                            UPDATE %s."%s"
-                            SET %s
-                            WHERE key=:key ;
-                            """ % (library_type_id, item_type, update_string)
-                            db.execute(text(query), **data )
-                        else :
-                            query = """
-                            INSERT INTO %s."%s" (%s)
-                            VALUES ( %s ) ;
-                            """ % (library_type_id, item_type, insert_field_string, insert_value_string)
-                            db.execute(text(query),  **data )
-                            inserts += 1
-                    round_duration = _duration(start_round)
-                    print( "Finished processing %i updates in %s seconds." % (len(update_list), str(round_duration)) )
-                    if len(update_list) == 100 and start+100 < total_results :
-                        print( "%i of %i updates done: fetching more updates now." % (start+100, total_results) )
-                        inserts = inserts + _fetch_updates_and_inserts(start=start+100)
-                    else :
-                        print( "%i of %i updates have been processed." % ( total_results, total_results ) )
+                written = checkpoint['rows_written']
+                done = checkpoint['page_start']
+                start_round = _start_duration()
+                if staging :
+                    # Everything is new, so page through full items
+                    pages = _pages(z, library_id, library_type, api_key, last_sync_version, done)
+                    first_page, total_results = next(pages)
+                    pages = itertools.chain([first_page], (page for page,_ in pages))
                 else :
+                    # Only fetch items whose remote version differs from the local one.
+                    # Items written before an interruption already match, so this resumes by itself.
+                    remote_versions = z.items(limit=None, format='versions', since=last_sync_version, includeTrashed=1)
+                    changed_keys = store.changed_keys(db, library_type_id, remote_versions)
+                    print( "%i of %i items changed since version %i differ from the local mirror." % (len(changed_keys), len(remote_versions), last_sync_version) )
+                    done = 0
+                    total_results = len(changed_keys)
+                    pages = _pages_by_keys(library_id, library_type, api_key, changed_keys, stats=stats)
+                # Maybe there are only deletions to handle, so checking number of updates to handle
+                if total_results - done <= 0 :
                     round_duration = _duration(start_round)
                     print( "Zero updates to process (it took %s seconds to figure that out)" % str(round_duration) )
-                return inserts
+                    return (inserts, written)
+                page_number = 0
+                page_snapshot = stats.snapshot()
+                for update_list in pages :
+                    start_encode = time.perf_counter()
+                    rows = [ encoders.encode(item) for item in update_list ]
+                    stats.add(rows_encoded=len(rows), encode_seconds=time.perf_counter() - start_encode)
+                    # A page and its checkpoint are committed together
+                    with db.begin() :
+                        page_inserts, page_updates = write_items(db, library_type_id, rows)
+                        inserts += page_inserts
+                        written += page_inserts + page_updates
+                        done += len(update_list)
+                        checkpoint.update(page_start=done, rows_written=written)
+                        store.write_checkpoint(db, library_type_id, **checkpoint)
+                        metrics.record(db, sync[0], library_type_id, stats.since(page_snapshot), page_number)
+                    page_number += 1
+                    page_snapshot = stats.snapshot()
+                    round_duration = _duration(start_round)
+                    print( "Finished processing %i updates in %s seconds." % (len(update_list), str(round_duration)) )
+                    print( "%i of %i updates have been processed." % ( done, total_results ) )
+                    start_round = _start_duration()
+                return (inserts, written)
             # fetch all updates in batches of 100 (includes updates to existing items and new items)
-            inserts = _fetch_updates_and_inserts()
+            inserts, written = _fetch_updates_and_inserts()
 
             def _fetch_deletions(since_version) :
-                deletions = 0
                 start_round = _start_duration()
                 print( "Fetching list of deletions since last successful sync." )
                 # Get list of deleted items from cloud
                 delete_list = z.deleted(since=since_version)
-                if len(delete_list['items']) > 0:
-                    for item in delete_list['items'] :
-                        if item in local_versions:
-                            query = """
-                            DELETE FROM %s.items WHERE key=:key ;
-                            """ % library_type_id
-                            db.execute(text(query), key=item)
-                            deletions += 1
-                        else:
-                            print("Tried to DELETE item with key %s, but this item is not in local library..." % item )
+                deleted = store.delete_items(db, library_type_id, delete_list['items'], sync[0])
+                # <lib>.fulltext is kept once created, also by syncs without --fulltext
+                if schema.has_table(db, '%s.fulltext' % library_type_id) :
+                    store.delete_objects(db, library_type_id, 'fulltext', deleted)
+                for item in set(delete_list['items']) - set(deleted) :
+                    print("Tried to DELETE item with key %s, but this item is not in local library..." % item )
                 round_duration = _duration(start_round)
                 print("Finished processing %i deletions in %s seconds" % ( len(delete_list['items']), str(round_duration) ) )
-                return deletions
+                return len(deleted)
 
             # if this is not the initial sync, there's nothing to delete...
+            if staging :
+                start_round = _start_duration()
+                store.swap_staging(db, library_type_id, schema.view_ddl(library_type_id, item_type_schema, layout) if storage == 'own' else [],
+                    schema.index_ddl(library_type_id, 'items_staging', layout=layout), schema.shared_table(storage),
+                    schema.view_names(item_type_schema))
+                print("Staging table replaced %s.items in %s seconds" % (library_type_id, str(_duration(start_round))))
             if last_sync_version > 0:
                 deletions = _fetch_deletions(last_sync_version)
                 final_count = local_count[0] + inserts - deletions
@@ -220,12 +524,27 @@ def _from_zotero_library(engine, library_id, library_type, api_key = None, verbo
         else :
             print("Nothing to sync, everything is up to date.")
 
+        _sync_objects(z, db, library_type_id, library_version, full)
+        if schema.fulltext :
+            _sync_fulltext(z, db, library_type_id, library_version, full)
+        if files_directory :
+            _sync_files(z, db, library_type_id, library_version, files_directory, layout, full)
+
         duration = _duration(sync[1])
-        query = """
-        UPDATE logs.zot_fetch
-        SET duration=:duration, version=:version
-        WHERE id=:id ;
-        """
-        db.execute(text(query), duration=math.ceil(duration), version=library_version, id=sync[0])
+        # Listeners are notified when the sync is logged as complete
+        with db.begin() :
+            store.finish_sync(db, sync[0], library_version, duration)
+            if last_sync_version < library_version :
+                store.notify_changes(db, library_type_id, sync[0], last_sync_version, library_version, last_sync_version == 0)
+        store.clear_checkpoint(db, library_type_id)
+        totals = stats.snapshot()
+        metrics.record(db, sync[0], library_type_id, totals)
+        metrics.detach(db)
+        metrics.finish(library_type_id, dict(totals, rows_written=written, rows_deleted=deletions, sync_seconds=duration))
+        if verbose :
+            print("Requests: %(requests)i (%(request_seconds).1fs, %(bytes_received)i bytes, %(retries)i retries), "
+                  "encoding: %(rows_encoded)i rows (%(encode_seconds).1fs), database: %(statements)i statements (%(db_seconds).1fs)" % totals)
         # Closing connection to database ༺ with engine.connect() as db : ༻
     print("Syncing library %s took %s seconds\n" % (library_type_id, str(duration)))
+    return { 'library': library_type_id, 'name': library_name, 'version': library_version,
+             'written': written, 'deleted': deletions, 'duration': duration }
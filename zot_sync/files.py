@@ -0,0 +1,110 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import contextlib, hashlib, os, threading
+
+from . import api
+
+CHUNK_SIZE = 65536      # bytes read from the response and written to disk at a time
+
+class DownloadError(Exception):
+    ''' A download that ended early or whose content does not match its md5.
+    '''
+
+class ChecksumError(DownloadError):
+    ''' A download whose content does not match its md5.
+    '''
+
+# md5 of the files being downloaded by a thread of this process
+_claimed = set()
+_claimed_condition = threading.Condition()
+
+def path(directory, md5) :
+    """ Where a file is stored: by md5, in one of 256 subdirectories.
+    """
+    return os.path.join(directory, md5[:2], md5)
+
+@contextlib.contextmanager
+def _claim(md5) :
+    """ Let one thread at a time download a file, e.g. when two group
+        libraries that are synced at once share it.
+    """
+    with _claimed_condition :
+        while md5 in _claimed :
+            _claimed_condition.wait()
+        _claimed.add(md5)
+    try :
+        yield
+    finally :
+        with _claimed_condition :
+            _claimed.discard(md5)
+            _claimed_condition.notify_all()
+
+def _digest(filename) :
+    digest = hashlib.md5()
+    with open(filename, 'rb') as f :
+        for chunk in iter(lambda : f.read(CHUNK_SIZE), b'') :
+            digest.update(chunk)
+    return digest
+
+def download(z, directory, key, md5) :
+    """ Store the file of an attachment in `directory` under its md5, so that
+        a file of several attachments or libraries is kept once.
+        The response is streamed to <md5>.part, which becomes <md5> once its
+        md5 is verified; a partial file left by an interrupted download is
+        resumed with a range request. If it cannot be resumed, because the
+        server rejects the range (416) or the result does not match, it is
+        deleted and the file downloaded once more from the start.
+        Returns the size of the stored file, None if the attachment has no file.
+        Raises DownloadError if the file is incomplete or does not match.
+    """
+    target = path(directory, md5)
+    partial = target + '.part'
+    with _claim(md5) :
+        if os.path.exists(target) :
+            return os.path.getsize(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset == 0 :
+            return _fetch(z, key, md5, partial, target)
+        digest = _digest(partial)
+        if digest.hexdigest() == md5 :
+            os.replace(partial, target)
+            return offset
+        try :
+            return _fetch(z, key, md5, partial, target, offset, digest)
+        except api.ZoteroError as e :
+            if e.response.status_code != 416 :
+                raise
+        except ChecksumError :
+            pass
+        if os.path.exists(partial) :
+            os.remove(partial)
+        return _fetch(z, key, md5, partial, target)
+
+def _fetch(z, key, md5, partial, target, offset = 0, digest = None) :
+    """ Append the file from byte `offset` on to `partial`, whose content so far has `digest`,
+        and move it to `target` once complete and verified.
+    """
+    response = z.file(key, offset)
+    if response is None :
+        return None
+    with response :
+        if response.status_code != 206 :
+            # The server sent the whole file
+            offset = 0
+        if offset == 0 :
+            digest = hashlib.md5()
+        expected = offset + int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+        size = offset
+        with open(partial, 'ab' if offset else 'wb') as f :
+            for chunk in response.iter_content(CHUNK_SIZE) :
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    if expected is not None and size < expected :
+        raise DownloadError("%s: got %i of %i bytes, the rest is fetched next time" % (key, size, expected))
+    if digest.hexdigest() != md5 :
+        os.remove(partial)
+        raise ChecksumError("%s: content has md5 %s instead of %s" % (key, digest.hexdigest(), md5))
+    os.replace(partial, target)
+    return size
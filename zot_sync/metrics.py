@@ -0,0 +1,110 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import collections, contextlib, threading, time
+
+from sqlalchemy import event, text
+
+FIELDS = ('requests', 'request_seconds', 'bytes_received', 'retries',
+          'rows_encoded', 'encode_seconds', 'statements', 'db_seconds')
+
+# Totals of every library synced by this process, for the metrics file
+finished = []
+_finished_lock = threading.Lock()
+
+class Stats(object):
+    ''' Counters of one library sync, shared by the threads working on it.
+    '''
+    def __init__(self, library = None):
+        self.library = library
+        self.values = dict.fromkeys(FIELDS, 0)
+        self.lock = threading.Lock()
+
+    def add(self, **values):
+        with self.lock :
+            for field,value in values.items() :
+                self.values[field] += value
+
+    def snapshot(self):
+        with self.lock :
+            return dict(self.values)
+
+    def since(self, snapshot):
+        now = self.snapshot()
+        return { field: now[field] - snapshot[field] for field in FIELDS }
+
+def instrument(engine):
+    """ Count statements and time spent in the database for the Stats object
+        attached to a connection with attach().
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        stats = conn.info.get('stats')
+        if stats is not None :
+            stats.add(statements=1, db_seconds=time.perf_counter() - start)
+
+def attach(db, stats):
+    db.info['stats'] = stats
+
+def detach(db):
+    db.info.pop('stats', None)
+
+@contextlib.contextmanager
+def attached(db, stats):
+    """ Count the statements of a connection into `stats` within a block.
+        The counter is detached on errors as well: the info dict belongs to
+        the pooled connection, which would count into the next library's stats.
+    """
+    attach(db, stats)
+    try :
+        yield db
+    finally :
+        detach(db)
+
+def record(db, sync_id, library, values, page = None):
+    """ Store counters in logs.zot_fetch_stats, per page or (page NULL) per library.
+    """
+    query = """
+    INSERT INTO logs.zot_fetch_stats (sync_id, library, page, %s)
+    VALUES ( :sync_id, :library, :page, %s ) ;
+    """ % (', '.join(FIELDS), ', '.join(':%s' % f for f in FIELDS))
+    db.execute(text(query), sync_id=sync_id, library=library, page=page, **values)
+
+def finish(library, values):
+    """ Add the totals of a finished library sync to `finished`.
+    """
+    with _finished_lock :
+        finished.append((library, values))
+
+def collapse():
+    """ Sum `finished` to one entry per library, so a long-running process
+        keeps one entry per library instead of one per sync.
+    """
+    with _finished_lock :
+        totals = collections.OrderedDict()
+        for library,values in finished :
+            summed = totals.setdefault(library, {})
+            for field,value in values.items() :
+                summed[field] = summed.get(field, 0) + value
+        finished[:] = list(totals.items())
+
+def write_prometheus(path):
+    """ Write the totals of all finished library syncs in Prometheus text format.
+    """
+    collapse()
+    lines = []
+    names = []
+    for library,values in finished :
+        names += [ n for n in values if n not in names ]
+    for field in names :
+        name = 'zot_sync_%s_total' % field
+        lines.append('# TYPE %s counter' % name)
+        for library,values in finished :
+            if field in values :
+                lines.append('%s{library="%s"} %s' % (name, library, values[field]))
+    with open(path, 'w') as file :
+        file.write('\n'.join(lines) + '\n')
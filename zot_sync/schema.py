@@ -1,13 +1,17 @@
 # https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
 
-import datetime, json, math, os
+import datetime, hashlib, json, math, os, threading
 
 from sqlalchemy import create_engine, text
-import requests
 
-def entry(database, verbose = False):
+from . import api
+from . import metrics
+from . import store
+
+def entry(database, verbose = False, jobs = 1):
     """ Prepare database for sync logging.
         Creates a schema, tables, views and columns as needed
+        The connection pool is sized so that `jobs` libraries can be synced at once.
     """
     fields = {}
     fields['id'] = 'serial PRIMARY KEY'
@@ -17,8 +21,32 @@ def entry(database, verbose = False):
     fields['name'] = 'varchar(1023)'
     fields['duration'] = 'integer'
 
+    state_fields = {}
+    state_fields['sync_id'] = 'integer'
+    state_fields['since_version'] = 'integer'
+    state_fields['target_version'] = 'integer'
+    state_fields['page_start'] = 'integer'
+    state_fields['rows_written'] = 'integer'
+    state_fields['updated'] = 'timestamp with time zone DEFAULT now()'
+
+    stats_fields = {}
+    stats_fields['sync_id'] = 'integer'
+    stats_fields['library'] = 'varchar(15)'
+    stats_fields['page'] = 'integer'
+    stats_fields['timestamp'] = 'timestamp with time zone DEFAULT now()'
+    for field in metrics.FIELDS :
+        stats_fields[field] = 'double precision' if field.endswith('_seconds') else 'bigint'
+
+    change_fields = {}
+    change_fields['id'] = 'bigserial PRIMARY KEY'
+    change_fields['sync_id'] = 'integer'
+    change_fields['library'] = 'varchar(15)'
+    change_fields['key'] = 'char(8)'
+    change_fields['change'] = 'varchar(6)'
+
     # Database connection setup with sqlalchemy
-    engine = create_engine(database)
+    engine = create_engine(database, pool_size=max(5, jobs), max_overflow=max(10, jobs))
+    metrics.instrument(engine)
 
     with engine.connect() as db:
 
@@ -42,10 +70,100 @@ ALTER TABLE logs.zot_fetch ADD COLUMN IF NOT EXISTS "%s" %s;
             if verbose :
                 print(query)
 
+        # Looking up the last completed sync of a library must not scan the log
+        query = """
+CREATE INDEX IF NOT EXISTS zot_fetch_library_timestamp
+ON logs.zot_fetch (library, timestamp DESC) WHERE duration IS NOT NULL ;"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
+        # Neither must finding the unfinished syncs whose changes a resumed sync adopts
+        query = """
+CREATE INDEX IF NOT EXISTS zot_fetch_library_unfinished
+ON logs.zot_fetch (library, id) WHERE duration IS NULL ;"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
+        # Progress of unfinished syncs, one row per library
+        query = """
+CREATE TABLE IF NOT EXISTS logs.zot_sync_state ( library varchar(15) PRIMARY KEY );"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
+        for field,type in state_fields.items() :
+            query = """
+ALTER TABLE logs.zot_sync_state ADD COLUMN IF NOT EXISTS "%s" %s;
+            """ % (field, type)
+            db.execute(text(query))
+            if verbose :
+                print(query)
+
+        # Counters per page (page NULL: per library) of every sync
+        query = """
+CREATE TABLE IF NOT EXISTS logs.zot_fetch_stats ();"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
+        for field,type in stats_fields.items() :
+            query = """
+ALTER TABLE logs.zot_fetch_stats ADD COLUMN IF NOT EXISTS "%s" %s;
+            """ % (field, type)
+            db.execute(text(query))
+            if verbose :
+                print(query)
+
+        query = """
+CREATE INDEX IF NOT EXISTS zot_fetch_stats_sync_id ON logs.zot_fetch_stats (sync_id);"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
+        # Item keys inserted, updated or deleted by every sync, the change feed
+        query = """
+CREATE TABLE IF NOT EXISTS logs.zot_changes ();"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
+        for field,type in change_fields.items() :
+            query = """
+ALTER TABLE logs.zot_changes ADD COLUMN IF NOT EXISTS "%s" %s;
+            """ % (field, type)
+            db.execute(text(query))
+            if verbose :
+                print(query)
+
+        query = """
+CREATE INDEX IF NOT EXISTS zot_changes_sync_id ON logs.zot_changes (sync_id);"""
+        db.execute(text(query))
+        if verbose :
+            print(query)
+
     # pass on engine for further connections
     return engine
 
+# The schema is downloaded at most once per process and shared by all libraries
+_schema_cache = {}
+_schema_lock = threading.Lock()
+
 def from_zotero(flush_cache = False, verbose = False) :
+    with _schema_lock :
+        if flush_cache or 'schema' not in _schema_cache :
+            _schema_cache['schema'] = _from_zotero(flush_cache, verbose)
+        return _schema_cache['schema']
+
+def forget_cached() :
+    """ Drop the in-process schema, so the next library setup revalidates it
+        with Zotero. Long-running processes call this now and then.
+    """
+    with _schema_lock :
+        _schema_cache.clear()
+
+def _from_zotero(flush_cache = False, verbose = False) :
     schema_file = os.path.normpath(os.path.join(os.path.dirname(__file__), './schema.json'))
     try :
         with open(schema_file, 'r') as file :
@@ -58,12 +176,14 @@ def from_zotero(flush_cache = False, verbose = False) :
         headers = { 'Accept-Encoding' : 'gzip' }
     updated_schema = None
     try:
-        response = requests.get("https://api.zotero.org/schema", headers=headers)
-    except:
-        response = {}
-    if verbose :
+        response = api.get("/schema", headers=headers)
+    except Exception as e:
+        response = None
+        if verbose :
+            print(repr(e))
+    if verbose and response is not None :
         print(response.status_code)
-    if response.status_code == 200 :
+    if response is not None and response.status_code == 200 :
         updated_schema = response.json()
         updated_schema['headers'] = {}
         updated_schema['headers']['Accept-Encoding'] = 'gzip'
@@ -119,6 +239,36 @@ def _special_fields() :
     fields['relations'] = 'jsonb'
     return fields
 
+def _child_fields() :
+    ''' These fields only occur on child items (notes, attachments and annotations).
+    '''
+    fields = {}
+    fields['parentItem'] = 'char(8)'
+    fields['linkMode'] = 'varchar(31)'
+    fields['contentType'] = 'varchar(255)'
+    fields['charset'] = 'varchar(63)'
+    fields['filename'] = 'varchar(1023)'
+    fields['md5'] = 'char(32)'
+    fields['mtime'] = 'bigint'
+    fields['path'] = 'varchar(65535)'
+    fields['note'] = 'text'
+    return fields
+
+def _annotation_fields() :
+    ''' The fields of annotations, which the Zotero schema does not declare.
+    '''
+    fields = {}
+    fields['annotationType'] = 'varchar(15)'
+    fields['annotationText'] = 'text'
+    fields['annotationComment'] = 'text'
+    fields['annotationColor'] = 'varchar(15)'
+    fields['annotationPageLabel'] = 'varchar(63)'
+    fields['annotationSortIndex'] = 'varchar(63)'
+    fields['annotationPosition'] = 'text'
+    return fields
+
+_child_item_types = ('note', 'attachment', 'annotation')
+
 def _system_fields() :
     ''' Changes to these fields are only made by the Zotero API server.
     '''
@@ -139,84 +289,489 @@ def _meta_fields() :
     fields['creatorSummary'] = 'varchar(127)'
     return fields
 
-def for_library(engine, library_type_id, verbose = False):
+def for_library(engine, library_type_id, verbose = False, files_table = False):
     """ Prepare database table to accomodate all possible fields for storage.
-        Creates a schema, tables, views and columns as needed
+        Creates a schema, tables, views and columns as needed, <lib>.files
+        too if `files_table` is set.
+        The DDL is fingerprinted and the fingerprint kept as comment on the
+        library schema, so unchanged libraries skip the DDL entirely.
     """
-    schema = from_zotero(verbose)
-
-    fields = _key_field()
-    fields.update(_system_fields())
-    fields.update(_meta_fields())
-    fields.update(_special_fields())
-    fields.update(schema['fields'])
+    schema = from_zotero(verbose=verbose)
 
     with engine.connect() as db:
 
-        query = """
-CREATE SCHEMA IF NOT EXISTS %s""" % library_type_id ;
-        db.execute(text(query))
-        if verbose :
-            print(query)
+        # An existing library keeps its storage and layout, new ones get the defaults.
+        # Partitions of the shared table have the layout of that table.
+        storage = library_storage(db, library_type_id) or default_storage or 'own'
+        if storage == 'shared' :
+            layout = library_layout(db, SHARED_SCHEMA) or default_layout or 'wide'
+            _for_shared(db, schema, layout, verbose)
+            if store.attach_partition(db, library_type_id, shared_table(storage)) :
+                print("Attached %s.items to %s again" % (library_type_id, shared_table(storage)))
+        else :
+            layout = library_layout(db, library_type_id) or default_layout or 'wide'
+        # Tables of optional content are kept once created, whether or not this run syncs it,
+        # so the fingerprint does not change with the options of the command
+        statements = _library_ddl(library_type_id, schema, layout, storage,
+                                  fulltext or has_table(db, '%s.fulltext' % library_type_id),
+                                  files_table or has_table(db, '%s.files' % library_type_id))
+        fingerprint = hashlib.sha1('\n'.join(statements).encode('utf-8')).hexdigest()
 
         query = """
-CREATE TABLE IF NOT EXISTS %s.items ();""" % library_type_id
-        db.execute(text(query))
-        if verbose :
-            print(query)
+SELECT obj_description(to_regnamespace(:lib)::oid, 'pg_namespace') ;"""
+        if db.execute(text(query), lib=library_type_id).scalar() == fingerprint :
+            if verbose :
+                print("Schema %s is up to date, skipping DDL" % library_type_id)
+            return schema
+
+        with db.begin() :
+            for query in statements :
+                db.execute(text(query))
+                if verbose :
+                    print(query)
+            query = """
+COMMENT ON SCHEMA %s IS '%s' ;""" % (library_type_id, fingerprint)
+            db.execute(text(query))
+
+    return schema
+
+def has_table(db, table) :
+    """ Whether the table exists, e.g. <lib>.fulltext of a mirror that syncs full text.
+    """
+    query = """
+SELECT to_regclass(:table) IS NOT NULL ;"""
+    return db.execute(text(query), table=table).scalar()
+
+def library_layout(db, library_type_id) :
+    """ Return the layout of <lib>.items, 'wide' or 'compact', or None if there is no such table.
+    """
+    query = """
+SELECT bool_or(column_name = 'data') FROM information_schema.columns
+WHERE table_schema = :lib AND table_name = 'items' ;"""
+    compact = db.execute(text(query), lib=library_type_id).scalar()
+    if compact is None :
+        return None
+    return 'compact' if compact else 'wide'
+
+def library_storage(db, library_type_id) :
+    """ Return where <lib>.items is stored: 'own' for a table of the library,
+        'shared' for a partition of the shared table, None if there is no such table.
+        A partition left detached by an interrupted swap still counts as shared,
+        as it has the "library" column of the shared table.
+    """
+    query = """
+SELECT relispartition OR EXISTS (SELECT 1 FROM pg_attribute
+    WHERE attrelid = pg_class.oid AND attname = 'library' AND NOT attisdropped)
+FROM pg_class WHERE oid = to_regclass(:table) ;"""
+    partition = db.execute(text(query), table='%s.items' % library_type_id).scalar()
+    if partition is None :
+        return None
+    return 'shared' if partition else 'own'
+
+def rebuild_plan(db, library_type_id, schema, rebuild = False) :
+    """ Return (layout, storage, staging columns) of <lib>.items for a sync.
+        A rebuild (full re-sync or import) moves a library to default_layout
+        and default_storage; the staging table then needs the returned
+        {column: type}, which is None when the library stays as it is.
+    """
+    layout = library_layout(db, library_type_id)
+    storage = library_storage(db, library_type_id)
+    target_storage = default_storage or storage
+    if target_storage == 'shared' :
+        target_layout = library_layout(db, SHARED_SCHEMA) or default_layout or layout
+    else :
+        target_layout = default_layout or layout
+    if (target_layout, target_storage) == (layout, storage) :
+        return (layout, storage, None)
+    if not rebuild :
+        print("%s keeps its %s layout and %s storage, a full re-sync converts it" % (library_type_id, layout, storage))
+        return (layout, storage, None)
+    print("Converting %s from %s layout and %s storage to %s layout and %s storage" % (
+        library_type_id, layout, storage, target_layout, target_storage))
+    if target_storage == 'shared' :
+        # A partition needs exactly the columns of the shared table, including
+        # any that newer schemas no longer declare
+        _for_shared(db, schema, target_layout)
+        columns = _table_columns(db, '%s.items' % SHARED_SCHEMA)
+        columns.update(_shared_fields(library_type_id))
+    else :
+        columns = item_columns(schema, target_layout)
+    return (target_layout, target_storage, columns)
+
+def _table_columns(db, table) :
+    """ Return {column: type with default} of an existing table.
+    """
+    query = """
+SELECT a.attname, format_type(a.atttypid, a.atttypmod), pg_get_expr(d.adbin, d.adrelid)
+FROM pg_attribute a LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+WHERE a.attrelid = CAST(:table AS regclass) AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attnum ;"""
+    columns = {}
+    for name,type,default in db.execute(text(query), table=table).fetchall() :
+        columns[name] = type if default is None else '%s DEFAULT %s' % (type, default)
+    return columns
 
+def shared_table(storage) :
+    """ Return the table a library's items are a partition of, None for own storage.
+    """
+    return '%s.items' % SHARED_SCHEMA if storage == 'shared' else None
+
+def _shared_fields(library_type_id = None) :
+    ''' The partition key of the shared items table. Partitions default it to their library.
+    '''
+    fields = {}
+    fields['library'] = 'varchar(15) NOT NULL'
+    if library_type_id :
+        fields['library'] += " DEFAULT '%s'" % library_type_id
+    return fields
+
+def _for_shared(db, schema, layout, verbose = False) :
+    """ Create or update the shared items table and its per-type views.
+        Fingerprinted like library schemas; the advisory lock keeps
+        concurrent library setups from running this DDL at the same time.
+    """
+    table = '%s.items' % SHARED_SCHEMA
+    statements = []
+    statements.append("""
+CREATE SCHEMA IF NOT EXISTS %s""" % SHARED_SCHEMA)
+    statements.append("""
+CREATE TABLE IF NOT EXISTS %s ( library %s ) PARTITION BY LIST (library);""" % (table, _shared_fields()['library']))
+    # A partitioned table cannot have a primary key without the partition key;
+    # every partition has its own on "key"
+    for field,type in item_columns(schema, layout).items() :
+        statements.append("""
+ALTER TABLE %s ADD COLUMN IF NOT EXISTS "%s" %s;
+        """ % (table, field, type.replace(' PRIMARY KEY', '')))
+    statements += view_ddl(SHARED_SCHEMA, schema, layout, library_column=True)
+    fingerprint = hashlib.sha1('\n'.join(statements).encode('utf-8')).hexdigest()
+
+    with db.begin() :
+        query = """
+SELECT pg_advisory_xact_lock(hashtext(:name)) ;"""
+        db.execute(text(query), name=SHARED_SCHEMA)
+        query = """
+SELECT obj_description(to_regnamespace(:lib)::oid, 'pg_namespace') ;"""
+        if db.execute(text(query), lib=SHARED_SCHEMA).scalar() == fingerprint :
+            return
+        for query in statements :
+            db.execute(text(query))
+            if verbose :
+                print(query)
         query = """
-CREATE TABLE IF NOT EXISTS %s.meta ();""" % library_type_id
+COMMENT ON SCHEMA %s IS '%s' ;""" % (SHARED_SCHEMA, fingerprint)
         db.execute(text(query))
-        if verbose :
-            print(query)
 
-        for field,type in fields.items() :
-            query = """
-ALTER TABLE %s.items ADD COLUMN IF NOT EXISTS "%s" %s;
-            """ % (library_type_id, field, type)
+def _library_ddl(library_type_id, schema, layout = 'wide', storage = 'own', fulltext_table = False, files_table = False) :
+    """ List the DDL statements that set up a library schema,
+        with <lib>.fulltext and <lib>.files if asked for.
+    """
+    statements = []
+    statements.append("""
+CREATE SCHEMA IF NOT EXISTS %s""" % library_type_id)
+
+    if storage == 'shared' :
+        statements.append("""
+CREATE TABLE IF NOT EXISTS {lib}.items PARTITION OF {shared}.items
+( library DEFAULT '{lib}', PRIMARY KEY (key) ) FOR VALUES IN ('{lib}');""".format(lib = library_type_id, shared = SHARED_SCHEMA))
+    else :
+        statements += _table_ddl('%s.items' % library_type_id, item_columns(schema, layout))
+    statements += _table_ddl('%s.meta' % library_type_id, _library_meta_fields())
+    statements += _table_ddl('%s.collections' % library_type_id, _collection_fields())
+    statements += _table_ddl('%s.searches' % library_type_id, _search_fields())
+    statements += _table_ddl('%s.tags' % library_type_id, _tag_fields())
+
+    statements.append("""
+CREATE INDEX IF NOT EXISTS collections_parent ON %s.collections ("parentCollection");""" % library_type_id)
+
+    if fulltext_table :
+        statements += _table_ddl('%s.fulltext' % library_type_id, _fulltext_fields())
+        statements.append("""
+CREATE INDEX IF NOT EXISTS fulltext_tsv ON %s.fulltext USING gin (tsv);""" % library_type_id)
+
+    if files_table :
+        statements += _table_ddl('%s.files' % library_type_id, _files_fields())
+
+    statements += [ query for name,query in index_ddl(library_type_id, layout=layout) ]
+
+    # Partitions are served by the per-type views of the shared table
+    if storage == 'own' :
+        statements += view_ddl(library_type_id, schema, layout)
+
+    return statements
+
+def _table_ddl(table, fields) :
+    statements = []
+    statements.append("""
+CREATE TABLE IF NOT EXISTS %s ();""" % table)
+
+    for field,type in fields.items() :
+        statements.append("""
+ALTER TABLE %s ADD COLUMN IF NOT EXISTS "%s" %s;
+        """ % (table, field, type))
+    return statements
+
+# Secondary indexes on <lib>.items: (column, method). GIN indexes use
+# jsonb_path_ops, which serves containment queries like "tags" @> '[{"tag": "x"}]'.
+INDEXES = (
+    ('collections', 'gin'),
+    ('itemType', 'btree'),
+    ('dateModified', 'btree'),
+    ('parentItem', 'btree'),
+    ('tags', 'gin'),
+    ('creators', 'gin'),
+)
+
+# The compact layout keeps collections, tags and creators in "data",
+# where one GIN index serves containment queries on all of them
+COMPACT_INDEXES = (
+    ('data', 'gin'),
+    ('itemType', 'btree'),
+    ('dateModified', 'btree'),
+    ('parentItem', 'btree'),
+)
+
+# Create all declared indexes in for_library, not only the collection membership index
+auto_indexes = True
+
+# Create <lib>.fulltext and sync the full-text content of attachments into it
+fulltext = False
+FULLTEXT_CONFIG = 'simple'      # text search configuration, 'simple' suits libraries of mixed languages
+FULLTEXT_CHARS = 500000
+
+def index_ddl(library_type_id, table = 'items', declared = None, concurrently = False, layout = 'wide') :
+    """ List (name, statement) of the secondary indexes on <lib>.items.
+        Index names are prefixed with the table name, so indexes can be built
+        on a staging table and renamed when it replaces <lib>.items.
+    """
+    if declared is None :
+        declared = COMPACT_INDEXES if layout == 'compact' else INDEXES
+        declared = declared if auto_indexes else declared[:1]
+    indexes = []
+    for column,method in declared :
+        name = ('%s_%s' % (table, column)).lower()
+        if method == 'gin' :
+            using = 'gin ("%s" jsonb_path_ops)' % column
+        else :
+            using = '%s ("%s")' % (method, column)
+        indexes.append((name, """
+CREATE INDEX %sIF NOT EXISTS %s ON %s.%s USING %s;
+    """ % ('CONCURRENTLY ' if concurrently else '', name, library_type_id, table, using)))
+    return indexes
+
+def create_indexes(engine, library_type_id, verbose = False) :
+    """ Create all declared indexes on a library that are missing.
+        Builds run CONCURRENTLY, so syncs and readers are not blocked.
+    """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as db:
+        layout = library_layout(db, library_type_id)
+        declared = COMPACT_INDEXES if layout == 'compact' else INDEXES
+        for name,query in index_ddl(library_type_id, declared=declared, concurrently=True) :
             db.execute(text(query))
             if verbose :
                 print(query)
 
-        for item_type in schema['itemTypes'] :
-            view_fields = [
-            '"%s"'% s for s in list(_key_field().keys()) ] + [
-            '"%s"'% s for s in list(_system_fields().keys()) ] + [
-            '"%s"'% s for s in list(_meta_fields().keys()) ] + [
-            '"%s"'% s for s in list(_special_fields().keys()) ]
-
-            for field in item_type['fields'] :
-                view_name = field['field']
-                base_name = field.get('baseField', None)
-                if base_name=='undefined' :
-                    view_fields.remove('"%s"' % view_name)
-                    continue
-                if base_name :
-                    alias_name = '"%s" AS "%s"' % (base_name, view_name)
-                else :
-                    alias_name = '"%s"' % view_name
-                view_fields.append(alias_name)
-            field_string = ', '.join(view_fields)
-            query = """
+def index_report(engine, library_type_id = None) :
+    """ Return (schema, index, size in bytes, definition) of the indexes of one or all libraries.
+    """
+    query = """
+SELECT schemaname, indexname, pg_relation_size(format('%I.%I', schemaname, indexname)::regclass), indexdef
+FROM pg_indexes
+WHERE schemaname ~ '^zot_[ug]_[0-9]+$' AND (CAST(:lib AS text) IS NULL OR schemaname = :lib)
+ORDER BY schemaname, indexname ;"""
+    with engine.connect() as db:
+        return db.execute(text(query), lib=library_type_id).fetchall()
+
+def libraries(engine) :
+    """ Return the schema names of all mirrored libraries.
+    """
+    query = """
+SELECT nspname FROM pg_namespace WHERE nspname ~ '^zot_[ug]_[0-9]+$'
+AND to_regclass(quote_ident(nspname) || '.items') IS NOT NULL ORDER BY nspname ;"""
+    with engine.connect() as db:
+        return [ r[0] for r in db.execute(text(query)).fetchall() ]
+
+def _library_meta_fields() :
+    ''' Library version up to which each kind of object (collections, searches, tags) is synced.
+    '''
+    fields = {}
+    fields['object'] = 'varchar(31) PRIMARY KEY'
+    fields['version'] = 'integer'
+    fields['updated'] = 'timestamp with time zone DEFAULT now()'
+    return fields
+
+def _collection_fields() :
+    fields = _key_field()
+    fields['version'] = 'integer'
+    fields['name'] = 'varchar(65535)'
+    fields['parentCollection'] = 'char(8)'
+    fields['relations'] = 'jsonb'
+    fields['numCollections'] = 'integer'
+    fields['numItems'] = 'integer'
+    return fields
+
+def _search_fields() :
+    fields = _key_field()
+    fields['version'] = 'integer'
+    fields['name'] = 'varchar(65535)'
+    fields['conditions'] = 'jsonb'
+    return fields
+
+def _tag_fields() :
+    fields = {}
+    fields['tag'] = 'varchar(65535) PRIMARY KEY'
+    fields['version'] = 'integer'
+    return fields
+
+def _fulltext_fields() :
+    ''' Indexed full-text content of attachments. The tsvector is generated
+        by PostgreSQL (12 or later) from at most FULLTEXT_CHARS characters,
+        Zotero's default indexing limit, which keeps it below the tsvector size limit.
+    '''
+    fields = _key_field()
+    fields['version'] = 'integer'
+    fields['content'] = 'text'
+    fields['indexedPages'] = 'integer'
+    fields['totalPages'] = 'integer'
+    fields['indexedChars'] = 'integer'
+    fields['totalChars'] = 'integer'
+    fields['tsv'] = "tsvector GENERATED ALWAYS AS (to_tsvector('%s', left(coalesce(content, ''), %i))) STORED" % (FULLTEXT_CONFIG, FULLTEXT_CHARS)
+    return fields
+
+def _files_fields() :
+    ''' Manifest of the downloaded attachment files, stored by md5 in the files directory.
+        size is NULL for attachments the API has no file for.
+    '''
+    fields = _key_field()
+    fields['md5'] = 'char(32)'
+    fields['mtime'] = 'bigint'
+    fields['size'] = 'bigint'
+    return fields
+
+# Typed columns of the compact layout, next to the jsonb columns "data" and "meta"
+COMPACT_COLUMNS = ('key', 'version', 'itemType', 'dateAdded', 'dateModified', 'deleted', 'title', 'parentItem')
+
+# Layout of <lib>.items for new libraries and full re-syncs: 'wide' has a
+# column per field, 'compact' the hot columns and jsonb. None keeps the
+# layout of existing libraries and creates new ones wide.
+default_layout = None
+
+# Schema of the shared items table, list-partitioned by library, and its per-type views
+SHARED_SCHEMA = 'zot_shared'
+
+# Storage of <lib>.items for new libraries and full re-syncs: 'own' is a
+# table per library, 'shared' a partition of the shared table. None keeps
+# the storage of existing libraries and gives new ones their own table.
+default_storage = None
+
+def _compact_fields() :
+    ''' Columns of <lib>.items in the compact layout. The per-type views
+        expose the same columns as with the wide layout.
+    '''
+    fields = _key_field()
+    fields['version'] = 'integer'
+    fields['itemType'] = 'varchar(20)'
+    fields['dateAdded'] = 'timestamp with time zone'
+    fields['dateModified'] = 'timestamp with time zone'
+    fields['deleted'] = 'boolean DEFAULT FALSE'
+    fields['title'] = 'varchar(65535)'
+    fields['parentItem'] = 'char(8)'
+    fields['data'] = 'jsonb'
+    fields['meta'] = 'jsonb'
+    return fields
+
+def item_columns(schema, layout = 'wide') :
+    """ Return all columns of <lib>.items with their types.
+    """
+    if layout == 'compact' :
+        return _compact_fields()
+    fields = _key_field()
+    fields.update(_system_fields())
+    fields.update(_meta_fields())
+    fields.update(_special_fields())
+    fields.update(_child_fields())
+    fields.update(_annotation_fields())
+    fields.update(schema['fields'])
+    return fields
+
+def view_names(schema) :
+    """ Names of the per-type views, one per item type.
+    """
+    return [ item_type['itemType'] for item_type in schema['itemTypes'] ]
+
+def view_ddl(library_type_id, schema, layout = 'wide', library_column = False) :
+    """ List the statements that (re)create the per-type views of a library,
+        or with `library_column` those of the shared table, which start with
+        the library of each item. Both layouts give the views the same columns.
+    """
+    column_types = item_columns(schema)
+    statements = []
+    for item_type in schema['itemTypes'] :
+        # (column in the wide layout, field name in the view)
+        view_fields = [ (s, s) for s in
+            list(_key_field().keys()) +
+            list(_system_fields().keys()) +
+            list(_meta_fields().keys()) +
+            list(_special_fields().keys()) ]
+
+        for field in item_type['fields'] :
+            view_name = field['field']
+            base_name = field.get('baseField', None)
+            if base_name=='undefined' :
+                view_fields.remove((view_name, view_name))
+                continue
+            view_fields.append((base_name or view_name, view_name))
+        # Appended last, as CREATE OR REPLACE VIEW can only add columns at the end
+        if item_type['itemType'] == 'attachment' :
+            view_fields += [ (s, s) for s in list(_child_fields().keys()) ]
+        elif item_type['itemType'] == 'annotation' :
+            view_fields += [ (s, s) for s in ['parentItem'] + list(_annotation_fields().keys()) ]
+        elif item_type['itemType'] in _child_item_types :
+            view_fields += [ ('parentItem', 'parentItem') ]
+        if layout == 'compact' :
+            field_string = ', '.join(_compact_view_field(column, view_name, column_types[column]) for column,view_name in view_fields)
+        else :
+            field_string = ', '.join('"%s"' % column if column == view_name else '"%s" AS "%s"' % (column, view_name)
+                for column,view_name in view_fields)
+        if library_column :
+            field_string = '"library", ' + field_string
+        statements.append("""
 CREATE OR REPLACE VIEW %s."%s" AS
-SELECT %s FROM %s.items WHERE "itemType" = :type ;
-            """ % (library_type_id, item_type['itemType'], field_string, library_type_id)
-            db.execute(text(query), type = item_type['itemType'])
-            if verbose :
-                print(query)
+SELECT %s FROM %s.items WHERE "itemType" = '%s' ;
+        """ % (library_type_id, item_type['itemType'], field_string, library_type_id, item_type['itemType']))
 
-    return schema
+    return statements
 
-def _typeset_for_db(field, value, item_type) :
-    if type(value) != int and len(value)==0 :
-        return None
-    elif field in ('deleted') :
-        return str(value)
-    elif field in ('customJSON', 'creators', 'tags', 'collections', 'relations', 'createdByUser', 'lastModifiedByUser') :
-        return json.dumps(value)
+# Fields the compact layout takes from the API's meta object
+_compact_meta_fields = ('numChildren', 'createdByUser', 'lastModifiedByUser', 'parsedDate', 'creatorSummary', 'customJSON')
+
+def _compact_view_field(column, view_name, type) :
+    """ Select expression of a view field in the compact layout, cast to the
+        type of the matching wide column. Empty values are NULL, as the
+        wide layout stores them.
+    """
+    if column in COMPACT_COLUMNS :
+        return '"%s"' % column if column == view_name else '"%s" AS "%s"' % (column, view_name)
+    source = 'meta' if view_name in _compact_meta_fields else 'data'
+    if type == 'jsonb' :
+        expression = "NULLIF(NULLIF(NULLIF(%s->'%s', 'null'), '[]'), '{}')" % (source, view_name)
     else :
-        return value
+        expression = "CAST(NULLIF(%s->>'%s', '') AS %s)" % (source, view_name, type.replace(' DEFAULT FALSE', ''))
+    return '%s AS "%s"' % (expression, view_name)
+
+def columns_by_item_type(schema) :
+    """ Map every field of every item type to its column in <lib>.items.
+        Fields with a baseField are stored in the base column, which is
+        aliased back to the field name in the per-type views.
+    """
+    columns = {}
+    for item_type in schema['itemTypes'] :
+        columns[item_type['itemType']] = {}
+        for field in item_type['fields'] :
+            base_name = field.get('baseField', 'undefined')
+            if base_name == 'undefined' :
+                base_name = field['field']
+            columns[item_type['itemType']][field['field']] = base_name
+    return columns
 
 def _parse_JSON_from_note(value) :
     return json.dumps({'casetext' : json.dumps(value) })
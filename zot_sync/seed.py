@@ -0,0 +1,290 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import itertools, json, os, re, sqlite3, urllib.request
+
+from . import encode
+from . import schema
+from . import store
+from .fetch import _duration, _start_duration
+
+SEED_BATCH = 1000       # items per INSERT into the staging table
+SQLITE_BATCH = 5000     # itemIDs per round of queries against zotero.sqlite
+
+def _batches(iterable, size) :
+    iterator = iter(iterable)
+    while True :
+        batch = list(itertools.islice(iterator, size))
+        if not batch :
+            return
+        yield batch
+
+def seed_library(engine, library_type_id, library_name, library_version, items, objects = None, verbose = False) :
+    """ Bulk-load API-style items into <lib>.items through the staging table
+        of an initial sync, and log them as a completed sync at
+        `library_version`, so the next fetch only asks for later changes.
+        `objects` may hold the collections, searches and tags of the same
+        version; kinds that are missing are fetched in full by the next sync.
+    """
+    item_type_schema = schema.for_library(engine, library_type_id, verbose)
+    print("\n%s %s ¶\nSeeding library at version %i" % (library_type_id, library_name, library_version))
+    written = 0
+    with engine.connect() as db:
+        # Logged like a fetch: an interrupted import stays an unfinished sync
+        sync = store.start_sync(db, library_type_id, library_name)
+        start_time = sync[1]
+        # Seeding replaces all items, so it can change the layout and storage as well
+        layout, storage, staging_columns = schema.rebuild_plan(db, library_type_id, item_type_schema, True)
+        encoders = encode.for_schema(item_type_schema, layout)
+        store.clear_checkpoint(db, library_type_id)
+        store.create_staging(db, library_type_id, staging_columns)
+        for batch in _batches(items, SEED_BATCH) :
+            rows = [ encoders.encode(item) for item in batch ]
+            with db.begin() :
+                store.insert_items(db, library_type_id, rows)
+            written += len(rows)
+            if verbose :
+                print("%i items loaded after %s seconds" % (written, str(_duration(start_time))))
+        start_round = _start_duration()
+        store.swap_staging(db, library_type_id, schema.view_ddl(library_type_id, item_type_schema, layout) if storage == 'own' else [],
+            schema.index_ddl(library_type_id, 'items_staging', layout=layout), schema.shared_table(storage),
+            schema.view_names(item_type_schema))
+        print("Staging table replaced %s.items in %s seconds" % (library_type_id, str(_duration(start_round))))
+        objects = objects or {}
+        with db.begin() :
+            for object in ('collections', 'searches', 'tags') :
+                store.clear_objects(db, library_type_id, object)
+                if object in objects :
+                    if object == 'collections' :
+                        store.upsert_collections(db, library_type_id, objects[object])
+                    elif object == 'searches' :
+                        store.upsert_searches(db, library_type_id, objects[object])
+                    else :
+                        store.upsert_tags(db, library_type_id, objects[object], library_version)
+                    print("Seeded %i %s" % (len(objects[object]), object))
+                store.write_object_version(db, library_type_id, object, library_version if object in objects else 0)
+            duration = _duration(start_time)
+            store.finish_sync(db, sync[0], library_version, duration)
+            store.notify_changes(db, library_type_id, sync[0], 0, library_version, True)
+    print("Sync #%i seeded %i items in %s seconds, the next fetch continues from version %i\n" % (sync[0], written, str(duration), library_version))
+    return { 'library': library_type_id, 'name': library_name, 'version': library_version,
+             'written': written, 'deleted': 0, 'duration': duration }
+
+def from_json(engine, path, library_id = None, library_type = None, library_version = None, verbose = False) :
+    """ Seed a library from items in the JSON format of the Zotero web API,
+        saved as one array or as one item per line. The library defaults to the
+        one named in the items, its version to the highest item version.
+    """
+    with open(path, 'r', encoding='utf-8') as file :
+        first = file.read(1)
+        while first.isspace() :
+            first = file.read(1)
+        file.seek(0)
+        if first == '[' :
+            items = json.load(file)
+        else :
+            items = [ json.loads(line) for line in file if line.strip() ]
+    # Accept bare item data as well as full API items
+    items = [ item if 'data' in item else { 'key': item['key'], 'version': item['version'], 'data': item } for item in items ]
+    if len(items) == 0 :
+        raise ValueError("%s contains no items" % path)
+    library = items[0].get('library', {})
+    if library_id is None :
+        if 'id' not in library :
+            raise ValueError("%s does not name its library, provide its user or group id" % path)
+        library_id, library_type = library['id'], library['type']
+    library_type_id = "zot_%s_%i" % (library_type[:1], library_id)
+    if library_version is None :
+        library_version = max(item['data']['version'] for item in items)
+    return seed_library(engine, library_type_id, library.get('name', library_type_id), library_version, items, verbose=verbose)
+
+def from_sqlite(engine, path, library_id, library_type, verbose = False) :
+    """ Seed a library from the zotero.sqlite database of the Zotero desktop
+        client, at the library version of its last sync. Items with local
+        changes the client has not synced yet are left out; they are fetched
+        once the client has uploaded them. Close Zotero first, it locks the file.
+    """
+    sqlite = sqlite3.connect('file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(path)), uri=True)
+    try :
+        if library_type[:1] == 'u' :
+            settings = dict(sqlite.execute("SELECT key, value FROM settings WHERE setting='account'").fetchall())
+            if str(settings.get('userID')) != str(library_id) :
+                raise ValueError("%s belongs to user %s, not to user %i" % (path, settings.get('userID'), library_id))
+            res = sqlite.execute("SELECT libraryID, version FROM libraries WHERE type='user'").fetchone()
+            library_name = settings.get('username', str(library_id))
+        else :
+            res = sqlite.execute("SELECT libraryID, libraries.version, name FROM groups JOIN libraries USING (libraryID) WHERE groupID=?", (library_id,)).fetchone()
+            if res is None :
+                raise ValueError("group %i is not in %s" % (library_id, path))
+            library_name = res[2]
+        local_id, library_version = res[0], res[1]
+        if not library_version :
+            raise ValueError("library %s %i was never synced by this Zotero client" % (library_type, library_id))
+        library_type_id = "zot_%s_%i" % (library_type[:1], library_id)
+        reader = _SqliteLibrary(sqlite, local_id, schema.from_zotero(verbose=verbose))
+        result = seed_library(engine, library_type_id, library_name, library_version, reader.items(), reader.objects(), verbose)
+        if reader.unsynced :
+            print("%i items with unsynced local changes were left out" % reader.unsynced)
+        return result
+    finally :
+        sqlite.close()
+
+_link_modes = { 0: 'imported_file', 1: 'imported_url', 2: 'linked_file', 3: 'linked_url', 4: 'embedded_image' }
+_annotation_types = { 1: 'highlight', 2: 'note', 3: 'image', 4: 'ink', 5: 'underline', 6: 'text' }
+_sql_date = re.compile(r'^(\d{4}-\d{2}-\d{2}) (.*)$')
+
+def _iso(timestamp) :
+    """ zotero.sqlite keeps UTC timestamps as 'YYYY-MM-DD HH:MM:SS'.
+    """
+    return timestamp.replace(' ', 'T') + 'Z' if timestamp else None
+
+def _creator_summary(creators, primary) :
+    names = [ c.get('lastName', c.get('name')) for c in creators if c['creatorType'] == primary ]
+    if len(names) == 0 :
+        return None
+    elif len(names) == 1 :
+        return names[0]
+    elif len(names) == 2 :
+        return '%s and %s' % tuple(names)
+    return '%s et al.' % names[0]
+
+class _SqliteLibrary(object):
+    ''' Reads the items of one library from zotero.sqlite in the shape of the
+        web API's JSON, SQLITE_BATCH items at a time.
+    '''
+    def __init__(self, sqlite, local_id, item_type_schema):
+        self.sqlite = sqlite
+        self.local_id = local_id
+        self.unsynced = 0
+        self.primary_creators = {}
+        for item_type in item_type_schema['itemTypes'] :
+            for creator_type in item_type.get('creatorTypes', []) :
+                if creator_type.get('primary') :
+                    self.primary_creators[item_type['itemType']] = creator_type['creatorType']
+        self.tables = set(r[0] for r in sqlite.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"))
+        self.keys = dict(sqlite.execute("SELECT itemID, key FROM items WHERE libraryID=?", (local_id,)).fetchall())
+        self.collection_keys = dict(sqlite.execute("SELECT collectionID, key FROM collections WHERE libraryID=?", (local_id,)).fetchall())
+
+    def _grouped(self, query, first, last) :
+        """ Run a query returning (itemID, ...) rows for an itemID range and group them by itemID.
+        """
+        grouped = {}
+        for row in self.sqlite.execute(query, (self.local_id, first, last)) :
+            grouped.setdefault(row[0], []).append(row[1:])
+        return grouped
+
+    def items(self) :
+        ids = sorted(self.keys)
+        for batch in _batches(ids, SQLITE_BATCH) :
+            yield from self._items(batch[0], batch[-1])
+
+    def _items(self, first, last) :
+        where = "JOIN items USING (itemID) WHERE libraryID=? AND itemID BETWEEN ? AND ?"
+        fields = self._grouped("""
+            SELECT itemID, fieldName, value FROM itemData
+            JOIN fieldsCombined USING (fieldID) JOIN itemDataValues USING (valueID) %s""" % where, first, last)
+        creators = self._grouped("""
+            SELECT itemID, creatorType, firstName, lastName, fieldMode FROM itemCreators
+            JOIN creators USING (creatorID) JOIN creatorTypes USING (creatorTypeID) %s
+            ORDER BY itemID, orderIndex""" % where, first, last)
+        tags = self._grouped("""
+            SELECT itemID, name, itemTags.type FROM itemTags JOIN tags USING (tagID) %s""" % where, first, last)
+        collections = self._grouped("""
+            SELECT itemID, collectionID FROM collectionItems %s""" % where, first, last)
+        relations = self._grouped("""
+            SELECT itemID, predicate, object FROM itemRelations JOIN relationPredicates USING (predicateID) %s""" % where, first, last)
+        notes = self._grouped("""
+            SELECT itemID, parentItemID, note FROM itemNotes %s""" % where, first, last)
+        attachments = self._grouped("""
+            SELECT itemID, parentItemID, linkMode, contentType, charset, path, storageModTime, storageHash
+            FROM itemAttachments LEFT JOIN charsets USING (charsetID) %s""" % where, first, last)
+        annotations = {}
+        if 'itemAnnotations' in self.tables :
+            annotations = self._grouped("""
+                SELECT itemID, parentItemID, itemAnnotations.type, text, comment, color, pageLabel, sortIndex, position
+                FROM itemAnnotations %s""" % where, first, last)
+        deleted = self._grouped("""
+            SELECT itemID, 1 FROM deletedItems %s""" % where, first, last)
+        children = self._grouped("""
+            SELECT c.parentItemID, c.itemID FROM (
+                SELECT parentItemID, itemID FROM itemNotes UNION ALL SELECT parentItemID, itemID FROM itemAttachments
+            ) c JOIN items ON items.itemID = c.parentItemID
+            WHERE libraryID=? AND parentItemID BETWEEN ? AND ?
+            AND c.itemID NOT IN (SELECT itemID FROM deletedItems)""", first, last)
+        query = """
+            SELECT itemID, key, version, synced, typeName, dateAdded, dateModified
+            FROM items JOIN itemTypesCombined USING (itemTypeID)
+            WHERE libraryID=? AND itemID BETWEEN ? AND ? ORDER BY itemID"""
+        for item_id, key, version, synced, item_type, date_added, date_modified in self.sqlite.execute(query, (self.local_id, first, last)) :
+            if not synced or not version :
+                self.unsynced += 1
+                continue
+            data = { 'key': key, 'version': version, 'itemType': item_type,
+                     'dateAdded': _iso(date_added), 'dateModified': _iso(date_modified) }
+            meta = {}
+            for field,value in fields.get(item_id, []) :
+                if field == 'date' :
+                    match = _sql_date.match(value)
+                    if match :
+                        value = match.group(2)
+                        meta['parsedDate'] = re.sub(r'(-00)+$', '', match.group(1)) if match.group(1)[:4] != '0000' else None
+                data[field] = value
+            data['creators'] = [ dict({ 'creatorType': c[0] }, **({ 'name': c[2] } if c[3] == 1 else { 'firstName': c[1], 'lastName': c[2] }))
+                for c in creators.get(item_id, []) ]
+            data['tags'] = [ dict({ 'tag': t[0] }, **({ 'type': t[1] } if t[1] else {})) for t in tags.get(item_id, []) ]
+            data['collections'] = [ self.collection_keys[c[0]] for c in collections.get(item_id, []) if c[0] in self.collection_keys ]
+            data['relations'] = {}
+            for predicate,object in relations.get(item_id, []) :
+                if predicate in data['relations'] :
+                    previous = data['relations'][predicate]
+                    data['relations'][predicate] = (previous if isinstance(previous, list) else [previous]) + [object]
+                else :
+                    data['relations'][predicate] = object
+            if item_id in deleted :
+                data['deleted'] = True
+            parent = None
+            if item_id in notes :
+                parent, data['note'] = notes[item_id][0]
+            if item_id in attachments :
+                parent, link_mode, content_type, charset, path, mtime, md5 = attachments[item_id][0]
+                data.update(linkMode=_link_modes.get(link_mode), contentType=content_type, charset=charset)
+                if path and path.startswith('storage:') :
+                    data.update(filename=path[len('storage:'):], md5=md5, mtime=mtime)
+                elif path :
+                    data['path'] = path
+            if item_id in annotations :
+                parent, annotation_type, annotation_text, comment, color, page_label, sort_index, position = annotations[item_id][0]
+                data.update(annotationType=_annotation_types.get(annotation_type), annotationText=annotation_text,
+                    annotationComment=comment, annotationColor=color, annotationPageLabel=page_label,
+                    annotationSortIndex=sort_index, annotationPosition=position)
+            if parent :
+                data['parentItem'] = self.keys.get(parent)
+            else :
+                meta['numChildren'] = len(children.get(item_id, []))
+                meta['creatorSummary'] = _creator_summary(data['creators'], self.primary_creators.get(item_type))
+            yield { 'key': key, 'version': version, 'data': data, 'meta': meta }
+
+    def objects(self) :
+        """ Return the collections, saved searches and tags of the library as the web API lists them.
+        """
+        collections = []
+        query = """
+            SELECT collectionID, key, version, collectionName, parentCollectionID,
+            (SELECT COUNT(*) FROM collections c WHERE c.parentCollectionID = collections.collectionID),
+            (SELECT COUNT(*) FROM collectionItems ci WHERE ci.collectionID = collections.collectionID)
+            FROM collections WHERE libraryID=? AND synced AND version > 0"""
+        for collection_id, key, version, name, parent, num_collections, num_items in self.sqlite.execute(query, (self.local_id,)) :
+            collections.append({ 'key': key, 'version': version,
+                'data': { 'key': key, 'version': version, 'name': name,
+                          'parentCollection': self.collection_keys.get(parent, False), 'relations': {} },
+                'meta': { 'numCollections': num_collections, 'numItems': num_items } })
+        searches = []
+        query = """
+            SELECT savedSearchID, key, version, savedSearchName FROM savedSearches WHERE libraryID=? AND synced AND version > 0"""
+        for search_id, key, version, name in self.sqlite.execute(query, (self.local_id,)).fetchall() :
+            conditions = [ { 'condition': c[0], 'operator': c[1], 'value': c[2] } for c in self.sqlite.execute(
+                "SELECT condition, operator, value FROM savedSearchConditions WHERE savedSearchID=? ORDER BY searchConditionID", (search_id,)) ]
+            searches.append({ 'key': key, 'version': version, 'data': { 'key': key, 'version': version, 'name': name, 'conditions': conditions } })
+        query = """
+            SELECT DISTINCT name FROM tags JOIN itemTags USING (tagID) JOIN items USING (itemID) WHERE libraryID=?"""
+        tags = [ r[0] for r in self.sqlite.execute(query, (self.local_id,)) ]
+        return { 'collections': collections, 'searches': searches, 'tags': tags }
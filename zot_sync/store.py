@@ -0,0 +1,522 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import json, math
+
+from sqlalchemy import text
+
+# Channel of the notification sent when a sync of a library commits
+CHANGES_CHANNEL = 'zot_changes'
+
+def upsert_items(db, library_type_id, rows, sync_id = None) :
+    """ Write a page of items into <lib>.items with a single statement.
+        Rows may be of different item types and carry different columns:
+        cells missing from a row are written as DEFAULT, so the column union
+        of the page can be sent as one multi-row INSERT ... ON CONFLICT.
+        With a `sync_id` the written keys are logged in logs.zot_changes by
+        the same statement.
+        Returns a tuple (inserts, updates).
+    """
+    changes = (sync_id, library_type_id) if sync_id is not None else None
+    return _write_rows(db, '%s.items' % library_type_id, rows, 'key', changes)
+
+def insert_items(db, library_type_id, rows) :
+    """ Append a page of items to the staging table of an initial load.
+        Returns a tuple (inserts, updates) like upsert_items.
+    """
+    return _write_rows(db, '%s.items_staging' % library_type_id, rows)
+
+def upsert_collections(db, library_type_id, collections) :
+    rows = [ {
+        'key': c['key'],
+        'version': c['version'],
+        'name': c['data']['name'],
+        'parentCollection': c['data'].get('parentCollection') or None,
+        'relations': json.dumps(c['data'].get('relations', {})),
+        'numCollections': c.get('meta', {}).get('numCollections'),
+        'numItems': c.get('meta', {}).get('numItems'),
+    } for c in collections ]
+    return _write_rows(db, '%s.collections' % library_type_id, rows, 'key')
+
+def upsert_searches(db, library_type_id, searches) :
+    rows = [ {
+        'key': s['key'],
+        'version': s['version'],
+        'name': s['data']['name'],
+        'conditions': json.dumps(s['data'].get('conditions', [])),
+    } for s in searches ]
+    return _write_rows(db, '%s.searches' % library_type_id, rows, 'key')
+
+def upsert_tags(db, library_type_id, tags, version) :
+    rows = [ { 'tag': tag, 'version': version } for tag in set(tags) ]
+    return _write_rows(db, '%s.tags' % library_type_id, rows, 'tag')
+
+def upsert_fulltext(db, library_type_id, contents, versions) :
+    """ Write full-text contents, a dict of key: API response, at the given versions.
+    """
+    rows = [ {
+        'key': key,
+        'version': versions[key],
+        'content': content.get('content'),
+        'indexedPages': content.get('indexedPages'),
+        'totalPages': content.get('totalPages'),
+        'indexedChars': content.get('indexedChars'),
+        'totalChars': content.get('totalChars'),
+    } for key,content in contents.items() ]
+    return _write_rows(db, '%s.fulltext' % library_type_id, rows, 'key')
+
+def delete_orphaned_fulltext(db, library_type_id) :
+    """ Delete full-text contents of attachments that are no longer in <lib>.items.
+    """
+    query = """
+    DELETE FROM {lib}.fulltext f WHERE NOT EXISTS (SELECT 1 FROM {lib}.items i WHERE i.key = f.key) ;
+    """.format(lib = library_type_id)
+    db.execute(text(query))
+
+# Attachment fields of a file in <lib>.items, by layout
+_FILE_COLUMNS = {
+    'wide': { 'linkMode': 'i."linkMode"', 'md5': 'i."md5"', 'mtime': 'i."mtime"' },
+    'compact': { 'linkMode': "i.data->>'linkMode'", 'md5': "i.data->>'md5'", 'mtime': "CAST(i.data->>'mtime' AS bigint)" },
+}
+
+def pending_files(db, library_type_id, layout = 'wide', every = False) :
+    """ Return (key, md5, mtime) of the attachments with a stored file whose
+        md5 or mtime differ from <lib>.files, or of all of them with `every`.
+    """
+    query = """
+    SELECT i.key, {md5}, {mtime} FROM {lib}.items i LEFT JOIN {lib}.files f ON f.key = i.key
+    WHERE i."itemType" = 'attachment' AND {linkMode} IN ('imported_file', 'imported_url') AND {md5} IS NOT NULL
+    AND ( :every OR f.key IS NULL OR f.md5 IS DISTINCT FROM {md5} OR f.mtime IS DISTINCT FROM {mtime} )
+    ORDER BY {md5} ;
+    """.format(lib = library_type_id, **_FILE_COLUMNS[layout])
+    return [ tuple(r) for r in db.execute(text(query), every=every).fetchall() ]
+
+def upsert_files(db, library_type_id, rows) :
+    """ Record downloaded files in <lib>.files, rows are dicts of key, md5, mtime and size.
+    """
+    return _write_rows(db, '%s.files' % library_type_id, rows, 'key')
+
+def delete_orphaned_files(db, library_type_id, layout = 'wide') :
+    """ Forget the files of attachments that are gone or no longer have one.
+        The stored files are kept, other attachments or libraries may share them.
+    """
+    query = """
+    DELETE FROM {lib}.files f WHERE NOT EXISTS (
+        SELECT 1 FROM {lib}.items i WHERE i.key = f.key AND {md5} IS NOT NULL ) ;
+    """.format(lib = library_type_id, **_FILE_COLUMNS[layout])
+    db.execute(text(query))
+
+def delete_objects(db, library_type_id, table, keys) :
+    """ Delete collections, searches (by key) or tags (by name) with a single statement.
+    """
+    if len(keys) == 0 :
+        return []
+    column = 'tag' if table == 'tags' else 'key'
+    query = """
+    DELETE FROM %s.%s WHERE %s = ANY(:keys) RETURNING %s ;
+    """ % (library_type_id, table, column, column)
+    return [r[0] for r in db.execute(text(query), keys=list(keys)).fetchall()]
+
+def clear_objects(db, library_type_id, table) :
+    query = """
+    DELETE FROM %s.%s ;
+    """ % (library_type_id, table)
+    db.execute(text(query))
+
+def read_object_version(db, library_type_id, object) :
+    """ Return the library version up to which an object kind is synced, 0 if never.
+    """
+    query = """
+    SELECT version FROM %s.meta WHERE object=:object ;
+    """ % library_type_id
+    return db.execute(text(query), object=object).scalar() or 0
+
+def write_object_version(db, library_type_id, object, version) :
+    query = """
+    INSERT INTO %s.meta (object, version, updated) VALUES ( :object, :version, now() )
+    ON CONFLICT (object) DO UPDATE SET version=EXCLUDED.version, updated=EXCLUDED.updated ;
+    """ % library_type_id
+    db.execute(text(query), object=object, version=version)
+
+def _write_rows(db, table, rows, conflict = None, changes = None) :
+    """ Write rows into a table with one multi-row INSERT, as upsert on the
+        `conflict` column if given. Rows are dicts or (columns, values) tuples
+        as made by the encoders. With `changes`, a tuple (sync_id, library),
+        the upserted keys are logged as inserts or updates.
+        Returns a tuple (inserts, updates).
+    """
+    if len(rows) == 0 :
+        return (0, 0)
+    if isinstance(rows[0], dict) :
+        rows = [ (tuple(row), tuple(row.values())) for row in rows ]
+    # One VALUES template per column signature (i.e. per item type) in the page
+    columns = []
+    templates = {}
+    for signature,row in rows :
+        if signature not in templates :
+            templates[signature] = None
+            columns += [ c for c in signature if c not in columns ]
+    position = { c: j for j,c in enumerate(columns) }
+    for signature in templates :
+        cells = ['DEFAULT'] * len(columns)
+        for column in signature :
+            cells[position[column]] = ':p{0}_%i' % position[column]
+        names = [ 'p{0}_%i' % position[column] for column in signature ]
+        templates[signature] = ('( %s )' % ', '.join(cells), names)
+    params = {}
+    values = []
+    for i,(signature,row) in enumerate(rows) :
+        template, names = templates[signature]
+        values.append(template.format(i))
+        params.update(zip([ name.format(i) for name in names ], row))
+    column_string = ', '.join('"%s"' % c for c in columns)
+    if conflict is None :
+        query = """
+    INSERT INTO %s (%s)
+    VALUES %s ;
+    """ % (table, column_string, ',\n    '.join(values))
+        db.execute(text(query), **params)
+        return (len(rows), 0)
+    update_string = ', '.join('"%s"=EXCLUDED."%s"' % (c, c) for c in columns if c != conflict)
+    query = """
+    INSERT INTO %s (%s)
+    VALUES %s
+    ON CONFLICT (%s) DO UPDATE SET %s
+    RETURNING "%s", (xmax = 0) AS inserted""" % (table, column_string, ',\n    '.join(values), conflict, update_string, conflict)
+    if changes is None :
+        query += " ;"
+    else :
+        query = """
+    WITH written AS (%s ),
+    logged AS (
+    INSERT INTO logs.zot_changes (sync_id, library, key, change)
+    SELECT :changes_sync_id, :changes_library, "%s", CASE WHEN inserted THEN 'insert' ELSE 'update' END FROM written )
+    SELECT "%s", inserted FROM written ;
+    """ % (query, conflict, conflict)
+        params.update(changes_sync_id=changes[0], changes_library=changes[1])
+    result = db.execute(text(query), **params).fetchall()
+    inserts = sum(1 for r in result if r[1])
+    return (inserts, len(result) - inserts)
+
+def delete_items(db, library_type_id, keys, sync_id = None) :
+    """ Delete all given item keys and their child items from <lib>.items
+        with a single statement, logged in logs.zot_changes with a `sync_id`.
+        Returns the list of keys that were actually deleted.
+    """
+    if len(keys) == 0 :
+        return []
+    query = """
+    DELETE FROM %s.items WHERE key = ANY(:keys) OR "parentItem" = ANY(:keys) RETURNING key ;
+    """ % library_type_id
+    if sync_id is not None :
+        query = """
+    WITH deleted AS (
+    DELETE FROM %s.items WHERE key = ANY(:keys) OR "parentItem" = ANY(:keys) RETURNING key ),
+    logged AS (
+    INSERT INTO logs.zot_changes (sync_id, library, key, change)
+    SELECT :sync_id, :lib, key, 'delete' FROM deleted )
+    SELECT key FROM deleted ;
+    """ % library_type_id
+    return [r[0] for r in db.execute(text(query), keys=list(keys), sync_id=sync_id, lib=library_type_id).fetchall()]
+
+def changed_keys(db, library_type_id, remote_versions) :
+    """ Compare remote {key: version} pairs with <lib>.items in one pass.
+        Returns the sorted keys that are missing locally or at another version.
+    """
+    if len(remote_versions) == 0 :
+        return []
+    query = """
+    SELECT r.key FROM unnest(CAST(:keys AS text[]), CAST(:versions AS integer[])) AS r(key, version)
+    LEFT JOIN %s.items i ON i.key = r.key
+    WHERE i.key IS NULL OR i.version IS DISTINCT FROM r.version
+    ORDER BY r.key ;
+    """ % library_type_id
+    keys = list(remote_versions.keys())
+    versions = [ remote_versions[key] for key in keys ]
+    return [r[0] for r in db.execute(text(query), keys=keys, versions=versions).fetchall()]
+
+def drift(db, library_type_id, remote_versions) :
+    """ Compare all remote {key: version} pairs of a library with <lib>.items.
+        The remote pairs go into a temporary table with one statement and are
+        matched against the mirror in one full join. Returns a dict of sorted
+        keys: 'missing' locally, 'stale' at another version locally, and
+        'orphaned' locally but gone remotely.
+    """
+    result = { 'missing': [], 'stale': [], 'orphaned': [] }
+    with db.begin() :
+        query = """
+    CREATE TEMPORARY TABLE remote_versions (key char(8) PRIMARY KEY, version integer) ON COMMIT DROP ;
+    """
+        db.execute(text(query))
+        query = """
+    INSERT INTO remote_versions SELECT * FROM unnest(CAST(:keys AS text[]), CAST(:versions AS integer[])) ;
+    """
+        keys = list(remote_versions.keys())
+        db.execute(text(query), keys=keys, versions=[ remote_versions[key] for key in keys ])
+        query = """
+    SELECT COALESCE(r.key, i.key),
+           CASE WHEN i.key IS NULL THEN 'missing' WHEN r.key IS NULL THEN 'orphaned' ELSE 'stale' END
+    FROM remote_versions r FULL JOIN %s.items i ON i.key = r.key
+    WHERE i.key IS NULL OR r.key IS NULL OR i.version IS DISTINCT FROM r.version
+    ORDER BY 1 ;
+    """ % library_type_id
+        for key,kind in db.execute(text(query)).fetchall() :
+            result[kind].append(key)
+    return result
+
+def start_sync(db, library_type_id, name) :
+    """ Log the start of a sync in logs.zot_fetch and return (id, timestamp).
+        The sync counts as completed once finish_sync gives it a duration.
+    """
+    query = """
+    INSERT INTO logs.zot_fetch (timestamp, library, name)
+    VALUES ( DEFAULT, :lib, :name ) RETURNING id,timestamp ;
+    """
+    return db.execute(text(query), lib=library_type_id, name=name).fetchone()
+
+def finish_sync(db, sync_id, version, duration) :
+    """ Log a sync as completed at a library version after `duration` seconds.
+    """
+    query = """
+    UPDATE logs.zot_fetch SET duration=:duration, version=:version WHERE id=:id ;
+    """
+    db.execute(text(query), duration=math.ceil(duration), version=version, id=sync_id)
+
+def last_sync(db, library_type_id) :
+    """ Return (version, name) of the last completed sync of a library, or None.
+        A library whose schema was dropped counts as never synced.
+    """
+    query = """
+    SELECT version, name FROM logs.zot_fetch
+    WHERE library=:lib AND duration IS NOT NULL AND to_regnamespace(:lib) IS NOT NULL
+    ORDER BY timestamp DESC LIMIT 1 ;
+    """
+    return db.execute(text(query), lib=library_type_id).fetchone()
+
+def adopt_changes(db, library_type_id, sync_id) :
+    """ Move the logged changes of interrupted syncs of a library to `sync_id`.
+        Their keys are not written again when the sync resumes, and their
+        syncs never notified. The unfinished syncs are found by the partial
+        index zot_fetch_library_unfinished.
+    """
+    query = """
+    UPDATE logs.zot_changes SET sync_id = :sync_id
+    WHERE library = :lib AND sync_id IN (
+        SELECT id FROM logs.zot_fetch WHERE library = :lib AND duration IS NULL AND id < :sync_id ) ;
+    """
+    db.execute(text(query), lib=library_type_id, sync_id=sync_id)
+
+def notify_changes(db, library_type_id, sync_id, since_version, version, reload = False) :
+    """ Send the changes of a sync to listeners of CHANGES_CHANNEL. Within a
+        transaction PostgreSQL delivers it at commit, i.e. when the sync is
+        complete. The payload is a JSON object with the library, the sync id
+        (its keys are in logs.zot_changes), the version range and whether
+        all items were reloaded, which logs no keys.
+    """
+    payload = json.dumps({ 'library': library_type_id, 'sync': sync_id,
+        'since': since_version, 'version': version, 'reload': reload })
+    db.execute(text("SELECT pg_notify(:channel, :payload) ;"), channel=CHANGES_CHANNEL, payload=payload)
+
+def read_checkpoint(db, library_type_id) :
+    """ Return the saved progress of an unfinished sync of this library or None.
+    """
+    query = """
+    SELECT sync_id, since_version, target_version, page_start, rows_written
+    FROM logs.zot_sync_state WHERE library=:lib ;
+    """
+    res = db.execute(text(query), lib=library_type_id).fetchone()
+    if res is None :
+        return None
+    return dict(zip(('sync_id', 'since_version', 'target_version', 'page_start', 'rows_written'), res))
+
+def write_checkpoint(db, library_type_id, sync_id, since_version, target_version, page_start, rows_written) :
+    query = """
+    INSERT INTO logs.zot_sync_state (library, sync_id, since_version, target_version, page_start, rows_written, updated)
+    VALUES ( :lib, :sync_id, :since_version, :target_version, :page_start, :rows_written, now() )
+    ON CONFLICT (library) DO UPDATE SET
+    sync_id=EXCLUDED.sync_id, since_version=EXCLUDED.since_version, target_version=EXCLUDED.target_version,
+    page_start=EXCLUDED.page_start, rows_written=EXCLUDED.rows_written, updated=EXCLUDED.updated ;
+    """
+    db.execute(text(query), lib=library_type_id, sync_id=sync_id, since_version=since_version,
+        target_version=target_version, page_start=page_start, rows_written=rows_written)
+
+def clear_checkpoint(db, library_type_id) :
+    query = """
+    DELETE FROM logs.zot_sync_state WHERE library=:lib ;
+    """
+    db.execute(text(query), lib=library_type_id)
+
+def create_staging(db, library_type_id, columns = None) :
+    """ Create an empty, unlogged and unindexed copy of <lib>.items for an initial load,
+        or with the given {column: type} instead, to change the layout of a library.
+    """
+    if columns is None :
+        definition = 'LIKE %s.items INCLUDING DEFAULTS' % library_type_id
+    else :
+        # The primary key is added by swap_staging
+        definition = ', '.join('"%s" %s' % (c, t.replace(' PRIMARY KEY', '')) for c,t in columns.items())
+    query = """
+    DROP TABLE IF EXISTS %s.items_staging ;
+    CREATE UNLOGGED TABLE %s.items_staging (%s) ;
+    """ % (library_type_id, library_type_id, definition)
+    db.execute(text(query))
+
+def staging_count(db, library_type_id) :
+    """ Count rows in the staging table, or return None if there is none.
+        Unlogged tables are emptied after a crash, so a resumed initial load
+        checks this against its checkpoint.
+    """
+    query = """
+    SELECT to_regclass(:table) IS NOT NULL ;
+    """
+    if not db.execute(text(query), table='%s.items_staging' % library_type_id).scalar() :
+        return None
+    query = """
+    SELECT COUNT(*) FROM %s.items_staging ;
+    """ % library_type_id
+    return db.execute(text(query)).scalar()
+
+class DependencyError(Exception):
+    ''' Objects that zot-sync did not create depend on a table it has to replace.
+    '''
+
+def foreign_dependents(db, table, generated_views = ()) :
+    """ List the views, materialized views and foreign keys that depend on a
+        table, except the per-type views named in `generated_views` in the
+        schema of the table, which zot-sync recreates itself.
+    """
+    query = """
+    SELECT DISTINCT n.nspname, c.relname, c.relkind::text FROM pg_depend d
+    JOIN pg_rewrite r ON r.oid = d.objid
+    JOIN pg_class c ON c.oid = r.ev_class
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass
+    AND d.refobjid = to_regclass(:table) AND c.oid <> d.refobjid
+    UNION ALL
+    SELECT n.nspname, c.relname, 'f:' || con.conname FROM pg_constraint con
+    JOIN pg_class c ON c.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE con.contype = 'f' AND con.confrelid = to_regclass(:table)
+    ORDER BY 1, 2 ;
+    """
+    schema = table.split('.')[0]
+    dependents = []
+    for namespace,name,kind in db.execute(text(query), table=table).fetchall() :
+        if kind == 'v' and namespace == schema and name in generated_views :
+            continue
+        if kind.startswith('f:') :
+            dependents.append('foreign key %s on %s."%s"' % (kind[2:], namespace, name))
+        else :
+            dependents.append('%s %s."%s"' % ('materialized view' if kind == 'm' else 'view', namespace, name))
+    return dependents
+
+def _partition_state(db, table) :
+    """ Return (parent, detach pending) of a partition, None if the table is none.
+    """
+    query = """
+    SELECT inhparent::regclass::text, inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(:table) ;
+    """
+    return db.execute(text(query), table=table).fetchone()
+
+def _autocommit(db, query) :
+    """ Run a statement that cannot be part of a transaction block on a
+        connection of its own.
+    """
+    with db.engine.connect() as autocommit :
+        autocommit.execution_options(isolation_level='AUTOCOMMIT').execute(text(query))
+
+def detach_partition(db, library_type_id) :
+    """ Detach <lib>.items from the table it is a partition of.
+        DETACH PARTITION ... CONCURRENTLY (PostgreSQL 14) only locks the
+        partition, so queries on the shared table are not blocked. A detach
+        that was interrupted is finalized.
+        Returns the table it was detached from, None if it was no partition.
+    """
+    state = _partition_state(db, '%s.items' % library_type_id)
+    if state is None :
+        return None
+    parent, pending = state
+    query = """
+    ALTER TABLE {parent} DETACH PARTITION {lib}.items {mode} ;
+    """.format(lib = library_type_id, parent = parent, mode = 'FINALIZE' if pending else 'CONCURRENTLY')
+    _autocommit(db, query)
+    return parent
+
+def attach_partition(db, library_type_id, parent) :
+    """ Attach <lib>.items to `parent` as the partition of the library,
+        e.g. after a swap that was interrupted once the old partition was detached.
+        Finishes a pending detach first. Attaching locks the shared table only
+        against concurrent DDL; a CHECK constraint matching the partition bound
+        spares the scan of <lib>.items.
+        Returns whether the table was attached, False if it already was or does not exist.
+    """
+    table = '%s.items' % library_type_id
+    query = """
+    SELECT to_regclass(:table) IS NOT NULL ;
+    """
+    if not db.execute(text(query), table=table).scalar() :
+        return False
+    state = _partition_state(db, table)
+    if state is not None :
+        if not state[1] :
+            return False
+        detach_partition(db, library_type_id)
+    query = """
+    ALTER TABLE {parent} ATTACH PARTITION {lib}.items FOR VALUES IN ('{lib}') ;
+    """.format(lib = library_type_id, parent = parent)
+    db.execute(text(query))
+    return True
+
+def swap_staging(db, library_type_id, view_statements, index_statements = [], partition_of = None, generated_views = ()) :
+    """ Replace <lib>.items with the loaded staging table.
+        Duplicates from shifting pages are dropped and the primary key and
+        secondary indexes are built before the swap. The swap itself and the recreation of the
+        per-type views happen in one transaction, so readers see either the
+        old or the complete new library.
+        With `partition_of` the staging table replaces the library's partition
+        of that table; the other partitions are not touched.
+        An old partition is detached concurrently before the swap, as dropping
+        it would lock the whole shared table against readers.
+        Raises DependencyError, before anything is changed, if objects other
+        than the `generated_views` depend on <lib>.items, as the swap would
+        drop them. The staging table is kept, so the sync can be resumed.
+    """
+    dependents = foreign_dependents(db, '%s.items' % library_type_id, generated_views)
+    if dependents :
+        raise DependencyError("%s.items cannot be replaced, it is used by %s. Drop them before this sync and recreate them after it."
+            % (library_type_id, ', '.join(dependents)))
+    query = """
+    DELETE FROM {lib}.items_staging a USING {lib}.items_staging b
+    WHERE a.key = b.key AND (a.version, a.ctid) < (b.version, b.ctid) ;
+    ALTER TABLE {lib}.items_staging SET LOGGED ;
+    ALTER TABLE {lib}.items_staging ADD CONSTRAINT items_staging_pkey PRIMARY KEY (key) ;
+    """.format(lib = library_type_id)
+    db.execute(text(query))
+    if partition_of :
+        # Proves the partition bound, so attaching does not scan the table again
+        query = """
+    ALTER TABLE {lib}.items_staging ADD CONSTRAINT items_staging_library CHECK (library = '{lib}') ;
+    """.format(lib = library_type_id)
+        db.execute(text(query))
+    for name,query in index_statements :
+        db.execute(text(query))
+    detach_partition(db, library_type_id)
+    with db.begin() :
+        query = """
+    DROP TABLE {lib}.items CASCADE ;
+    ALTER TABLE {lib}.items_staging RENAME TO items ;
+    ALTER TABLE {lib}.items RENAME CONSTRAINT items_staging_pkey TO items_pkey ;
+    """.format(lib = library_type_id)
+        db.execute(text(query))
+        if partition_of :
+            attach_partition(db, library_type_id, partition_of)
+            query = """
+    ALTER TABLE {lib}.items DROP CONSTRAINT items_staging_library ;
+    """.format(lib = library_type_id)
+            db.execute(text(query))
+        for name,query in index_statements :
+            query = """
+    ALTER INDEX %s.%s RENAME TO items%s ;
+    """ % (library_type_id, name, name[len('items_staging'):])
+            db.execute(text(query))
+        for query in view_statements :
+            db.execute(text(query))
@@ -0,0 +1,183 @@
+# https://www.python.org/dev/peps/pep-0263/ encoding: utf-8
+
+import json, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import fetch
+from . import metrics
+from . import schema
+
+# Optional, only needed to follow the streaming API: pip install zot-sync[stream]
+try :
+    import websocket
+except ImportError :
+    websocket = None
+
+STREAM_URL = 'wss://stream.zotero.org'
+MIN_INTERVAL = 60           # seconds between polls of a library that changed
+MAX_INTERVAL = 3600         # longest interval an idle library backs off to
+SCHEMA_REFRESH = 86400      # revalidate the Zotero item schema once a day
+
+class Schedule(object):
+    ''' Due times of the watched libraries, shared by the sync threads.
+        A library that changed in its last sync is polled again after
+        min_interval, every poll without changes doubles its interval up to
+        max_interval. wake() makes a library due at once; a library woken
+        while it syncs is synced again right after.
+    '''
+    def __init__(self, libraries, min_interval = MIN_INTERVAL, max_interval = MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.intervals = {}
+        self.versions = {}
+        self.due = {}
+        self.running = set()
+        self.woken = set()
+        self.condition = threading.Condition()
+        for library in libraries :
+            self.intervals[library] = min_interval
+            self.due[library] = time.monotonic()
+
+    def next(self, timeout = None):
+        """ Wait for the next due library and mark it as running.
+            Returns None if none is due within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition :
+            while True :
+                now = time.monotonic()
+                wait = None
+                if self.due :
+                    due, library = min((due, library) for library,due in self.due.items())
+                    if due <= now :
+                        del self.due[library]
+                        self.running.add(library)
+                        return library
+                    wait = due - now
+                if deadline is not None :
+                    if now >= deadline :
+                        return None
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.condition.wait(wait)
+
+    def done(self, library, result):
+        """ Reschedule a library after its sync with the result of from_zotero_library.
+        """
+        with self.condition :
+            self.running.discard(library)
+            changed = result is not None and self.versions.get(library) != result['version']
+            if result is not None :
+                self.versions[library] = result['version']
+            if changed :
+                self.intervals[library] = self.min_interval
+            else :
+                self.intervals[library] = min(self.max_interval, self.intervals[library] * 2)
+            if library in self.woken :
+                self.woken.discard(library)
+                self.due[library] = time.monotonic()
+            else :
+                self.due[library] = time.monotonic() + self.intervals[library]
+            self.condition.notify_all()
+
+    def wake(self, library, version = None):
+        """ Make a library due now, unless it is already synced up to `version`.
+        """
+        with self.condition :
+            if library not in self.intervals :
+                return
+            if version is not None and self.versions.get(library) == version :
+                return
+            self.intervals[library] = self.min_interval
+            if library in self.running :
+                self.woken.add(library)
+            else :
+                self.due[library] = time.monotonic()
+            self.condition.notify_all()
+
+def topic(library_id, library_type) :
+    return '/%ss/%i' % ('user' if library_type[:1] == 'u' else 'group', library_id)
+
+def watch(engine, libraries, api_key = None, verbose = False, jobs = 1,
+          min_interval = MIN_INTERVAL, max_interval = MAX_INTERVAL, stream_url = None, metrics_file = None, stop = None,
+          files_directory = None) :
+    """ Keep a list of (library_id, library_type) tuples in sync until `stop`
+        (a threading.Event) is set or the process is interrupted.
+        Libraries are polled on adaptive intervals by up to `jobs` threads
+        sharing the engine's connection pool; with `stream_url` the Zotero
+        streaming API is followed as well and makes updated libraries due at once.
+        Attachment files are downloaded into `files_directory` if given.
+    """
+    stop = stop or threading.Event()
+    schedule = Schedule(libraries, min_interval, max_interval)
+    if stream_url :
+        listener = threading.Thread(target=_listen, args=(stream_url, schedule, libraries, api_key, stop), daemon=True)
+        listener.start()
+    print("Watching %i libraries, polling every %i to %i seconds%s" % (
+        len(libraries), min_interval, max_interval, ' and following %s' % stream_url if stream_url else ''))
+    metrics_lock = threading.Lock()
+    slots = threading.Semaphore(jobs)
+    def _sync(library) :
+        result = None
+        try :
+            result = fetch.from_zotero_library(engine, library[0], library[1], api_key, verbose, files_directory=files_directory)
+        except Exception as e :
+            # Verbose syncs raise instead of logging, the watch goes on regardless
+            print("\nsync of %s %i failed: %s ¶" % (library[1], library[0], e))
+        finally :
+            schedule.done(library, result)
+            with metrics_lock :
+                if metrics_file :
+                    metrics.write_prometheus(metrics_file)
+                else :
+                    metrics.collapse()
+            slots.release()
+    schema_refreshed = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool :
+        while not stop.is_set() :
+            if not slots.acquire(timeout=1) :
+                continue
+            library = schedule.next(timeout=1)
+            if library is None :
+                slots.release()
+                continue
+            if time.monotonic() - schema_refreshed > SCHEMA_REFRESH :
+                schema.forget_cached()
+                schema_refreshed = time.monotonic()
+            pool.submit(_sync, library)
+    return schedule
+
+def _listen(url, schedule, libraries, api_key, stop) :
+    """ Follow the Zotero streaming API and wake libraries on topicUpdated events.
+        The connection is reopened after the delay the server asks for.
+    """
+    topics = { topic(*library): library for library in libraries }
+    subscription = { 'topics': list(topics) }
+    if api_key :
+        subscription['apiKey'] = api_key
+    retry = 10
+    while not stop.is_set() :
+        try :
+            connection = websocket.create_connection(url, timeout=30)
+            try :
+                while not stop.is_set() :
+                    try :
+                        message = connection.recv()
+                    except websocket.WebSocketTimeoutException :
+                        connection.ping()
+                        continue
+                    if not message :
+                        break
+                    event = json.loads(message)
+                    if event['event'] == 'connected' :
+                        retry = event.get('retry', 10000) / 1000
+                        connection.send(json.dumps({ 'action': 'createSubscriptions', 'subscriptions': [subscription] }))
+                    elif event['event'] == 'subscriptionsCreated' :
+                        for error in event.get('errors', []) :
+                            print("stream subscription error: %s" % json.dumps(error))
+                    elif event['event'] == 'topicUpdated' and event['topic'] in topics :
+                        schedule.wake(topics[event['topic']], event.get('version'))
+            finally :
+                connection.close()
+        except (websocket.WebSocketException, OSError) as e :
+            print("stream connection lost (%s), reconnecting in %i seconds" % (e, retry))
+        stop.wait(retry)